@@ -8,6 +8,7 @@ import fire
 import toml
 import http
 import socketserver
+from datetime import datetime, timedelta
 
 from elltwo.tools import gen_auth
 from elltwo.convert import convert_latex
@@ -204,7 +205,7 @@ class Paragraph:
             print(para_summary(para))
 
     def hist(self, pid):
-        coms = self.edb.getall(dbs.Paragraph, pid=pid)
+        coms = self.edb.expand_paras(self.edb.getall(dbs.Paragraph, pid=pid))
         coms = sorted(coms, key=lambda c: c.create_time)
         print('\n'.join([para_summary(p, time=True) for p in coms]))
 
@@ -247,8 +248,18 @@ class Index:
     def __init__(self, edb):
         self.edb = edb
 
-    def regen(self):
-        self.edb.reindex_articles()
+    def regen(self, workers=None, chunk=10000):
+        def progress(stage, done, total):
+            print(f'\r{stage}: {done}/{total}', end='\n' if done == total else '', flush=True)
+        self.edb.reindex_articles(workers=workers, chunk=chunk, progress=progress)
+
+    def flush(self):
+        num = self.edb.flush_index()
+        print(f'reindexed {num} paragraphs')
+
+    def cache(self):
+        stats = self.edb.search_stats()
+        print(f'{stats["size"]} cached, {stats["hits"]} hits, {stats["misses"]} misses')
 
     def title(self, query):
         arts = self.edb.search_title(query)['arts']
@@ -260,6 +271,27 @@ class Index:
         for p in paras:
             print(p)
 
+    # compare sql or memory scoring to python on a query or on sampled vocabulary words
+    def check(self, query=None, samples=50, dtype=None, tol=1e-9, engine='sql'):
+        if engine == 'memory' and self.edb.memory is None:
+            self.edb.load_memory_index()
+        if query is not None:
+            queries = [query]
+        else:
+            queries = self.edb.sample_words(samples)
+        bad = 0
+        for q in queries:
+            res_py = dict(self.edb.search_index(q, dtype=dtype, engine='python'))
+            res_eng = dict(self.edb.search_index(q, dtype=dtype, engine=engine))
+            diff = [
+                k for k in res_py.keys() | res_eng.keys()
+                if abs(res_py.get(k, 0) - res_eng.get(k, 0)) > tol
+            ]
+            if len(diff) > 0:
+                bad += 1
+                print(f'{q}: {len(diff)} of {len(res_py)} results differ')
+        print(f'{len(queries)-bad} of {len(queries)} queries match')
+
 class Biblio:
     def __init__(self, edb):
         self.edb = edb
@@ -334,6 +366,30 @@ class Ingest:
             if ext == 'md':
                 self.markdown(f'{path}/{name}')
 
+class Schema:
+    def __init__(self, edb):
+        self.edb = edb
+
+    def migrate(self):
+        added = self.edb.migrate()
+        if len(added) > 0:
+            print('\n'.join([f'created {name}' for name in added]))
+        else:
+            print('Schema up to date')
+
+class History:
+    def __init__(self, edb):
+        self.edb = edb
+
+    def compact(self, days=30, granularity='hour', aid=None, vacuum=True):
+        horizon = datetime.utcnow() - timedelta(days=days)
+        dropped = self.edb.compact_history(horizon, granularity=granularity, aid=aid)
+        for name, num in dropped.items():
+            print(f'{name}: removed {num} rows')
+        if vacuum:
+            size0, size1 = self.edb.vacuum()
+            print(f'reclaimed {(size0-size1)//1024} KB ({size0//1024} KB → {size1//1024} KB)')
+
 class Serve:
     def file(self, path, host='localhost', port=8000):
         with open(path) as fid:
@@ -356,6 +412,8 @@ class Main:
         self.reference = self.ref = Reference(edb=edb)
         self.backup = Backup(edb=edb)
         self.ingest = Ingest(edb=edb)
+        self.schema = Schema(edb=edb)
+        self.history = self.hist = History(edb=edb)
         self.serve = Serve()
 
 if __name__ == '__main__':
@@ -1,19 +1,30 @@
-import re, os, toml
+import re, os, json, toml
 from math import ceil
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import partial
 from operator import itemgetter
+from itertools import chain
+from threading import Lock
 from collections import defaultdict
 from pathlib import Path
 from zipfile import ZipFile
 
-from sqlalchemy import create_engine, or_, and_, distinct, event
-from sqlalchemy.sql import func
+from sqlalchemy import (
+    create_engine, inspect, insert, update, delete, select, union, union_all, bindparam, or_,
+    and_, exists, event, MetaData, Table, Column, ForeignKey
+)
+from sqlalchemy.sql import func, literal
 from sqlalchemy.orm import sessionmaker, Query
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from .schema import Base, Article, Paragraph, Paralink, Bib, ExtRef, Image, User, TextShard, Tag
-from .tools import Multimap
+from .schema import (
+    Base, Article, Paragraph, Paralink, ParagraphHead, ParalinkHead, Blob, Journal, Checkpoint, Bib,
+    ExtRef, Image, User, IndexWord, IndexGram, WordPost, IndexQueue, Meta, Tag
+)
+from .tools import (
+    Multimap, LRUCache, IdAllocator, text_hash, text_delta, apply_delta, pool_map
+)
 
 ##
 ## image mime data
@@ -62,6 +73,8 @@ def table_dump(rows, index, cols, string=False):
 ##
 
 def intime(time, klass):
+    if time is None:
+        return klass.delete_time == None
     return and_(
         klass.create_time <= time,
         or_(
@@ -77,6 +90,32 @@ reftime = partial(intime, klass=ExtRef)
 tagtime = partial(intime, klass=Tag)
 imgtime = partial(intime, klass=Image)
 
+# conditions for col in (time1, time2] in either order, time1 None is the present
+def between_times(col, time1, time2):
+    if time1 is None:
+        return [col > time2]
+    return [
+        and_(col > time1, col <= time2),
+        and_(col > time2, col <= time1),
+    ]
+
+# text moved out to the blob table
+empty_hash = text_hash('')
+
+def in_blob(text, hash):
+    return text == '' and hash is not None and hash != empty_hash
+
+# history compaction buckets in seconds
+time_grains = {
+    'minute': 60,
+    'hour': 60*60,
+    'day': 24*60*60,
+    'week': 7*24*60*60,
+}
+
+def time_bucket(time, grain):
+    return int((time - datetime.min).total_seconds() // grain)
+
 def find_start(links):
     for p in links:
         if p.prev is None:
@@ -92,10 +131,25 @@ def link_sort(links):
         yield p.pid
 
 def splice_link(lin, time, **kwargs):
-    props = {**dict(pid=lin.pid, prev=lin.prev, next=lin.next), **kwargs}
+    props = {**dict(pid=lin.pid, prev=lin.prev, next=lin.next, rank=lin.rank), **kwargs}
     lin.delete_time = time
     return Paralink(aid=lin.aid, create_time=time, **props)
 
+# n evenly spaced ranks strictly between lo and hi (None for open ends)
+rank_gap = 1 << 20
+
+def rank_range(lo, hi, n=1):
+    if lo is None and hi is None:
+        lo, hi = 0, (n+1)*rank_gap
+    elif lo is None:
+        lo = hi - (n+1)*rank_gap
+    elif hi is None:
+        hi = lo + (n+1)*rank_gap
+    step = (hi-lo) // (n+1)
+    if step < 1:
+        return None
+    return [lo + step*(i+1) for i in range(n)]
+
 def urlify(s):
     return re.sub(r'\W', '_', s).lower()
 
@@ -135,10 +189,27 @@ def shardify(s):
     shgen = zip(*[s[k:len(s)-(2-k)] for k in range(3)])
     return [(''.join(x), i) for i, x in enumerate(shgen)]
 
+def shardify_words(words):
+    return [(w, shard_compress(shardify(f' {w} '))) for w in words]
+
 def shardify_document(doc):
     words = [f' {w} ' for w in doc.lower().split()]
     return {i: shardify(w) for i, w in enumerate(words)}
 
+# queries that shardify the same share results
+def search_key(doc):
+    return ' '.join(doc.lower().split())
+
+# full text of indexed paragraphs, kept by sqlite's fts5 when a search engine asks for it
+fts_table = 'paragraph_fts'
+
+# input as quoted terms, so operators are literal, the last a prefix as it is being typed
+def fts_query(doc):
+    terms = ['"' + t.replace('"', '""') + '"' for t in doc.split()]
+    if len(terms) > 0:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
 def shard_compress(shards):
     count = defaultdict(int)
     posit = defaultdict(int)
@@ -160,6 +231,25 @@ def shard_score(shards1, shards2):
             score += min(c1, c2)*dist_score(p1, p2)
     return score/ntoks
 
+# copy of a table without indexes, to be built and then renamed over it
+def shadow_table(tab, meta, suffix='_new'):
+    def copy(col):
+        fkeys = [
+            ForeignKey(f'{fk.column.table.name}{suffix}.{fk.column.name}')
+            for fk in col.foreign_keys
+        ]
+        return Column(col.name, col.type, *fkeys, primary_key=col.primary_key, nullable=col.nullable)
+    return Table(f'{tab.name}{suffix}', meta, *[copy(c) for c in tab.columns])
+
+# executemany straight through the driver, skipping per-row parameter processing
+def bulk_insert(con, tab, cols, rows):
+    if len(rows) == 0:
+        return
+    sql = str(insert(tab).compile(dialect=con.dialect, column_keys=cols))
+    if not con.dialect.positional:
+        rows = [dict(zip(cols, r)) for r in rows]
+    con.exec_driver_sql(sql, rows)
+
 # CES: constant elasticity of substitution
 # σ = 1 → sum
 # σ = ∞ → max
@@ -171,7 +261,9 @@ def ces(v, σ=2):
 ##
 
 class ElltwoDB:
-    def __init__(self, db=None, path='elltwo.db', uri=None, create=False, reindex=False):
+    def __init__(self, db=None, path='elltwo.db', uri=None, create=False, reindex=False, cache_size=128,
+                 checkpoint_every=100, keyframe=None, dedup=False, text_cache_size=4096,
+                 search_engine='sql', index_file=None, result_cache_size=256):
         if db is None:
             if uri is None:
                 uri = f'sqlite:///{path}'
@@ -183,15 +275,141 @@ class ElltwoDB:
             self.engine = db.engine
             self.session = db.session
 
+        # ordered pids of current articles
+        self.order = LRUCache(cache_size)
+
+        # pid counter, seeded on first use under the lock
+        self.pids = None
+        self.pid_lock = Lock()
+
+        # edits since last checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.edits = defaultdict(int)
+
+        # store old revisions as deltas, keeping every keyframe-th whole
+        self.keyframe = keyframe
+        self.texts = LRUCache(text_cache_size)
+
+        # store old revision texts once by hash
+        self.dedup = dedup
+
+        # score searches in the database, in python, or from memory, the latter
+        # mapped from index_file when it is up to date. paragraphs can also be
+        # searched with fts, and a dict picks an engine by dtype
+        self.search_engine = search_engine
+        self.index_file = index_file
+        self.memory = None
+        self.fts = False
+
+        # warming while a background rebuild runs
+        self.index_status = dict(state='ready')
+
+        # ranked search results, dropped when the index generation moves on
+        self.results = LRUCache(result_cache_size)
+        self.result_generation = None
+        self.result_stats = dict(hits=0, misses=0)
+
         if create:
             self.create()
 
+        # once created, the fts table is kept up to date whatever the engine
+        if 'fts' in self.search_engines():
+            self.create_fts()
+        else:
+            self.fts = fts_table in inspect(self.engine).get_table_names()
+
         if reindex:
             self.reindex_articles()
 
+        if 'memory' in self.search_engines():
+            self.load_memory_index()
+
     def create(self):
         Base.metadata.create_all(bind=self.engine)
 
+    def migrate(self):
+        added = []
+
+        # add new columns, derived tables are simply rebuilt
+        insp = inspect(self.engine)
+        tables = insp.get_table_names()
+        with self.engine.begin() as con:
+            for tab in Base.metadata.sorted_tables:
+                if tab.name not in tables:
+                    continue
+                cols = {c['name'] for c in insp.get_columns(tab.name)}
+                miss = [c for c in tab.columns if c.name not in cols]
+                if len(miss) == 0:
+                    continue
+                if tab.info.get('derived', False):
+                    tab.drop(bind=con)
+                    continue
+                for col in miss:
+                    ctype = col.type.compile(dialect=self.engine.dialect)
+                    con.exec_driver_sql(f'ALTER TABLE {tab.name} ADD COLUMN {col.name} {ctype}')
+                    added.append(f'{tab.name}.{col.name}')
+
+        # create missing tables
+        added += [tab.name for tab in Base.metadata.sorted_tables if tab.name not in tables]
+        self.create()
+
+        # create missing indexes, and recreate those whose columns changed
+        insp = inspect(self.engine)
+        exist = {
+            idx['name']: idx['column_names'] for tab in insp.get_table_names()
+            for idx in insp.get_indexes(tab)
+        }
+        for tab in Base.metadata.sorted_tables:
+            for idx in tab.indexes:
+                if (cols := exist.get(idx.name)) == [c.name for c in idx.columns]:
+                    continue
+                if cols is not None:
+                    idx.drop(bind=self.engine)
+                idx.create(bind=self.engine)
+                added.append(idx.name)
+
+        # hash revisions written before hashing
+        while len(paras := self.session.query(Paragraph).filter(Paragraph.hash == None).limit(1000).all()) > 0:
+            self.expand_paras(paras)
+            self.session.execute(
+                update(Paragraph)
+                .where(Paragraph.rid == bindparam('r'))
+                .values(hash=bindparam('h')),
+                [dict(r=p.rid, h=text_hash(p.text)) for p in paras]
+            )
+
+        # seed the journal from existing revisions
+        if self.session.query(Journal.jid).first() is None:
+            self.backfill_journal()
+
+        # snapshot articles that have never been checkpointed
+        latest = (self.session
+            .query(Journal.aid, func.max(Journal.time))
+            .filter(~Journal.aid.in_(self.session.query(Checkpoint.aid)))
+            .group_by(Journal.aid)
+            .all()
+        )
+        for aid, time in latest:
+            self.checkpoint(aid, time)
+
+        # fill in positions of current links
+        unranked = (self.session
+            .query(ParalinkHead.aid.distinct())
+            .filter(ParalinkHead.rank == None)
+            .all()
+        )
+        for aid, in unranked:
+            self.rerank(aid)
+        self.session.commit()
+
+        # the per-trigram index was replaced by the word index
+        if 'textshard' in tables:
+            with self.engine.begin() as con:
+                con.exec_driver_sql('DROP TABLE textshard')
+            self.reindex_articles()
+
+        return added
+
     ##
     ## diagnostic tools
     ##
@@ -208,12 +426,28 @@ class ElltwoDB:
             self.reset(time, klass=Article)
             self.reset(time, klass=Paragraph)
             self.reset(time, klass=Paralink)
+            self.session.query(Journal).filter(Journal.time > time).delete()
+            self.session.query(Checkpoint).filter(Checkpoint.time > time).delete()
+            self.prune_blobs()
+            self.session.commit()
         else:
+            if klass is Paragraph:
+                self.materialize(klass.create_time > time)
+                self.inline(klass.delete_time > time)
             for k in self.session.query(klass).filter(klass.create_time > time).all():
                 self.session.delete(k)
-            for k in self.session.query(klass).filter(klass.delete_time > time).all():
+            revived = self.session.query(klass).filter(klass.delete_time > time).all()
+            for k in revived:
                 k.delete_time = None
             self.session.commit()
+            self.order.clear()
+
+            # revived links keep ranks from before any later reranking
+            if klass is Paralink:
+                for aid in {k.aid for k in revived}:
+                    self.rerank(aid)
+                self.session.commit()
+            self.texts.clear()
 
     def purge_article(self, aid, klass=None, commit=True):
         if klass is None:
@@ -221,8 +455,13 @@ class ElltwoDB:
             self.purge_article(aid, klass=Paragraph, commit=False)
             self.purge_article(aid, klass=Paralink, commit=False)
             self.purge_article(aid, klass=ExtRef, commit=False)
+            self.purge_article(aid, klass=Journal, commit=False)
+            self.purge_article(aid, klass=Checkpoint, commit=False)
+            self.prune_blobs()
         else:
             self.session.query(klass).filter_by(aid=aid).delete()
+        self.order.pop(aid)
+        self.texts.clear()
         if commit:
             self.session.commit()
 
@@ -330,34 +569,82 @@ class ElltwoDB:
     ## query methods
     ##
 
-    def get_links(self, aid, time=None):
+    # current rows come from the head tables, past rows from the full history
+    def para_query(self, time=None, aid=None, pid=None):
+        query = self.session.query(Paragraph)
         if time is None:
-            time = datetime.utcnow()
-        query = (self.session
-            .query(Paralink)
-            .filter_by(aid=aid)
-            .filter(lintime(time))
-        )
-        return query.all()
-
-    def get_pids(self, aid, time=None):
-        links = self.get_links(aid, time=time)
-        return list(link_sort(links))
+            query = query.join(ParagraphHead, ParagraphHead.rid == Paragraph.rid)
+            klass = ParagraphHead
+        elif aid is not None:
+            # historical reads by article carry their own filter
+            query, aid = query.filter(self.hist_filter(Paragraph, time, aid)), None
+            klass = Paragraph
+        else:
+            query = query.filter(partime(time))
+            klass = Paragraph
+        if aid is not None:
+            query = query.filter(klass.aid == aid)
+        if pid is not None:
+            query = query.filter(klass.pid == pid)
+        return query
 
-    def get_paras(self, aid, pids=None, time=None):
+    def link_query(self, time=None, aid=None, pid=None):
+        query = self.session.query(Paralink)
         if time is None:
-            time = datetime.utcnow()
+            query = query.join(ParalinkHead, ParalinkHead.lid == Paralink.lid)
+            klass = ParalinkHead
+        elif aid is not None:
+            # historical reads by article carry their own filter
+            query, aid = query.filter(self.hist_filter(Paralink, time, aid)), None
+            klass = Paralink
+        else:
+            query = query.filter(lintime(time))
+            klass = Paralink
+        if aid is not None:
+            query = query.filter(klass.aid == aid)
+        if pid is not None:
+            query = query.filter(klass.pid == pid)
+        return query
+
+    def get_links(self, aid, time=None):
+        return self.link_query(time=time, aid=aid).all()
+
+    def get_pids(self, aid, time=None):
+        if time is not None:
+            links = self.get_links(aid, time=time)
+            return list(link_sort(links))
+
+        if (order := self.order.get(aid)) is None:
+            query = (self.session
+                .query(ParalinkHead.pid)
+                .filter_by(aid=aid)
+                .order_by(ParalinkHead.rank)
+            )
+            order = [p for p, in query.all()]
+            self.order.set(aid, order)
+
+        return list(order)
+
+    def get_paras(self, aid, pids=None, time=None, offset=0, limit=None):
+        # current slices come straight from the ordered index
+        if pids is None and time is None and (offset > 0 or limit is not None):
+            return self.expand_paras(self
+                .para_query(aid=aid)
+                .join(ParalinkHead, ParalinkHead.pid == ParagraphHead.pid)
+                .order_by(ParalinkHead.rank)
+                .offset(offset)
+                .limit(limit)
+                .all()
+            )
 
         if pids is None:
             pids = self.get_pids(aid, time=time)
-
-        query = (self.session
-            .query(Paragraph)
-            .filter_by(aid=aid)
-            .filter(partime(time))
-            .filter(Paragraph.pid.in_(pids))
-        )
-        paras = query.all()
+            if offset > 0 or limit is not None:
+                pids = pids[offset:None if limit is None else offset+limit]
+            query = self.para_query(time=time, aid=aid)
+        else:
+            query = self.para_query(time=time, aid=aid).filter(Paragraph.pid.in_(pids))
+        paras = self.expand_paras(query.all())
 
         index = {p.pid: p for p in paras}
         return [index[p] for p in pids]
@@ -415,8 +702,6 @@ class ElltwoDB:
         return query.one_or_none()
 
     def get_art_text(self, aid, time=None, strip=False):
-        if time is None:
-            time = datetime.utcnow()
         paras = [p.text for p in self.get_paras(aid, time=time)]
         if strip:
             paras = [re.sub('\n{2,}', '\n', p).strip('\n') for p in paras]
@@ -428,56 +713,64 @@ class ElltwoDB:
         return [t.tag for t in self.get_tags(aid, time=time)]
 
     def get_para(self, pid, time=None):
-        if time is None:
-            time = datetime.utcnow()
-        return (self.session
-            .query(Paragraph)
-            .filter_by(pid=pid)
-            .filter(partime(time))
-            .one_or_none()
-        )
+        if pid is None:
+            return
+        if (par := self.para_query(time=time, pid=pid).one_or_none()) is None:
+            return
+        return self.expand_paras([par])[0]
 
     def get_link(self, pid, time=None):
-        if time is None:
-            time = datetime.utcnow()
-        return (self.session
-            .query(Paralink)
-            .filter_by(pid=pid)
-            .filter(lintime(time))
-            .one_or_none()
-        )
+        if pid is None:
+            return
+        return self.link_query(time=time, pid=pid).one_or_none()
 
     def get_lid(self, lid):
         return self.session.query(Paralink).filter_by(lid=lid).one_or_none()
 
-    def search_title(self, words, taglist=None, thresh=0.25, time=None):
+    # k and offset page through the results, scoring only what is needed
+    def search_title(self, words, taglist=None, thresh=0.25, time=None, k=None, offset=0):
+        # only searches of current tags are cached
+        cached = time is None
         if time is None:
             time = datetime.utcnow()
 
-        # get articles with matching titles
-        if len(words) > 0:
-            match_title = {
-                i: s for i, s in self.search_index(words, dtype='title') if s > thresh
-            }
-        else:
-            match_title = {}
-
-        # get number of matched tags by article
-        if taglist:
-            match_tags = dict(self.session
-                .query(Tag.aid, func.count(Tag.tid).label('count'))
-                .filter(Tag.tag.in_(taglist))
-                .filter(tagtime(time))
-                .group_by(Tag.aid)
-                .all()
+        def compute():
+            # get articles with matching titles
+            if len(words) > 0:
+                if k is not None:
+                    sims = self.search_topk(words, k=k+offset, dtype='title', thresh=thresh)
+                else:
+                    sims = self.search_index(words, dtype='title', thresh=thresh)
+                match_title = {i: s for i, s in sims}
+            else:
+                match_title = {}
+
+            # get number of matched tags by article
+            if taglist:
+                match_tags = dict(self.session
+                    .query(Tag.aid, func.count(Tag.tid).label('count'))
+                    .filter(Tag.tag.in_(taglist))
+                    .filter(tagtime(time))
+                    .group_by(Tag.aid)
+                    .all()
+                )
+            else:
+                match_tags = {}
+
+            # lexico sort on number of tag matchs, closeness of title, revesed here
+            match_arts = sorted({*match_tags, *match_title},
+                key=lambda a: (match_tags.get(a, 0), match_title.get(a, 0)), reverse=True
             )
+            if k is not None:
+                match_arts = match_arts[offset:offset+k]
+            return match_arts
+
+        if cached:
+            tags = tuple(sorted(set(taglist))) if taglist else ()
+            key = ('title', search_key(words), tags, thresh, k, offset)
+            match_arts = self.cached_search(key, compute)
         else:
-            match_tags = {}
-
-        # lexico sort on number of tag matchs, closeness of title, revesed here
-        match_arts = sorted({*match_tags, *match_title},
-            key=lambda a: (match_tags.get(a, 0), match_title.get(a, 0)), reverse=True
-        )
+            match_arts = compute()
 
         # get resulting article entries
         arts = (self.session
@@ -487,40 +780,358 @@ class ElltwoDB:
             .all()
         )
 
-        return arts
-
-    def search_text(self, words, thresh=0.25, time=None):
-        if time is None:
-            time = datetime.utcnow()
+        # in match order, which pages rely on
+        rank = {aid: i for i, aid in enumerate(match_arts)}
+        return sorted(arts, key=lambda a: rank[a.aid])
 
+    def search_text(self, words, thresh=0.25, time=None, k=None, offset=0):
         # get matching paragraph list
-        match = {
-            i: s for i, s in self.search_index(words, dtype='para') if s > thresh
-        }
+        def compute():
+            if k is not None:
+                return self.search_topk(words, k=k, offset=offset, dtype='para', thresh=thresh)
+            else:
+                return self.search_index(words, dtype='para', thresh=thresh)
+        key = ('para', search_key(words), thresh, k, offset)
+        match = dict(self.cached_search(key, compute))
 
         # get resulting paragraph entries
-        paras = (self.session
-            .query(Paragraph)
+        paras = self.expand_paras(self
+            .para_query(time=time)
             .filter(Paragraph.pid.in_(match))
-            .filter(partime(time))
             .all()
         )
 
         return sorted(paras, key=lambda a: match[a.pid], reverse=True)
 
+    # emptied whenever any connection bumps the index generation, tag edits empty it directly
+    def cached_search(self, key, compute):
+        generation = self.index_generation()
+        if generation != self.result_generation:
+            self.results.clear()
+            self.result_generation = generation
+
+        if (match := self.results.get(key)) is not None:
+            self.result_stats['hits'] += 1
+            return match
+
+        self.result_stats['misses'] += 1
+        match = compute()
+        self.results.set(key, match)
+        return match
+
+    def search_stats(self):
+        return dict(**self.result_stats, size=len(self.results))
+
+    ##
+    ## order cache
+    ##
+
+    def order_insert(self, aid, pid, new_pids, after=True):
+        if (order := self.order.get(aid)) is None:
+            return
+        if pid not in order:
+            self.order.pop(aid)
+            return
+        i = order.index(pid) + (1 if after else 0)
+        order[i:i] = new_pids
+
+    def order_remove(self, aid, pids):
+        if (order := self.order.get(aid)) is None:
+            return
+        drop = set(pids)
+        order[:] = [p for p in order if p not in drop]
+
+    ##
+    ## link ranks
+    ##
+
+    # ranks only order the current links, so they are rewritten in place
+    def rerank(self, aid, gap=rank_gap):
+        links = self.get_links(aid)
+        index = {lin.pid: lin for lin in links}
+        pids = list(link_sort(links))
+        for i, pid in enumerate(pids):
+            index[pid].rank = (i+1)*gap
+        self.order.set(aid, pids)
+
+    def link_ranks(self, aid, prev, next, n=1):
+        def space():
+            lo = prev.rank if prev is not None else None
+            hi = next.rank if next is not None else None
+            if (prev is not None and lo is None) or (next is not None and hi is None):
+                return None
+            return rank_range(lo, hi, n)
+        if (ranks := space()) is None:
+            self.rerank(aid, gap=max(rank_gap, n+1))
+            ranks = space()
+        return ranks
+
+    ##
+    ## delta storage
+    ##
+
+    # store replaced revisions as deltas against their current successors,
+    # revs are the (rid, pid, text, depth) they had while current
+    def delta_encode(self, revs):
+        if len(revs) == 0:
+            return
+
+        # whatever stays whole goes to the blob table
+        if self.keyframe is None:
+            self.blob_store(Paragraph.rid.in_([r.rid for r in revs]))
+            return
+
+        # replacements are the current heads
+        succ = {
+            pid: (rid, text) for pid, rid, text in self
+                .para_query()
+                .filter(ParagraphHead.pid.in_([r.pid for r in revs]))
+                .with_entities(Paragraph.pid, Paragraph.rid, Paragraph.text)
+                .all()
+        }
+
+        deltas, depths = [], []
+        for r in revs:
+            if (s := succ.get(r.pid)) is None:
+                continue
+            rid1, text1 = s
+            depth = (r.depth or 0) + 1
+            if depth < self.keyframe:
+                delta = text_delta(text1, r.text)
+                if len(delta) < len(r.text):
+                    deltas.append(dict(r=r.rid, b=rid1, x=delta))
+                    depths.append(dict(r=rid1, d=depth))
+
+        if len(deltas) > 0:
+            self.session.execute(
+                update(Paragraph)
+                .where(Paragraph.rid == bindparam('r'))
+                .values(text=bindparam('x'), base=bindparam('b')),
+                deltas
+            )
+            self.session.execute(
+                update(Paragraph)
+                .where(Paragraph.rid == bindparam('r'))
+                .values(depth=bindparam('d')),
+                depths
+            )
+
+        self.blob_store(Paragraph.rid.in_([r.rid for r in revs]))
+
+    # fill in the full text of delta and blob revisions in place
+    def expand_paras(self, paras):
+        texts, bases, blobs, hashes = {}, {}, {}, {}
+        def visit(rid, base, text, hash):
+            # rids can be handed out again after a purge, so the hash goes in the key
+            hashes[rid] = hash
+            if (cached := self.texts.get((rid, hash))) is not None:
+                texts[rid] = cached
+            elif base is not None:
+                bases[rid] = (base, text)
+            elif in_blob(text, hash):
+                blobs[rid] = hash
+            else:
+                texts[rid] = text
+
+        stored = [p for p in paras if p.base is not None or in_blob(p.text, p.hash)]
+        for p in stored:
+            visit(p.rid, p.base, p.text, p.hash)
+
+        # walk forward until every chain reaches a whole revision
+        need = {b for b, _ in bases.values()}
+        while len(need := {b for b in need if b not in texts and b not in bases and b not in blobs}) > 0:
+            query = (self.session
+                .query(Paragraph.rid, Paragraph.base, Paragraph.text, Paragraph.hash)
+                .filter(Paragraph.rid.in_(need))
+            )
+            found = set()
+            for rid, base, text, hash in query.all():
+                visit(rid, base, text, hash)
+                found.add(rid)
+            # a purged or reset base would otherwise be asked for forever
+            if len(missing := need - found) > 0:
+                raise ValueError(f'missing base revisions: {sorted(missing)}')
+            need = {b for b, _ in bases.values()}
+
+        # look up blob texts all at once
+        if len(blobs) > 0:
+            query = self.session.query(Blob.hash, Blob.text).filter(Blob.hash.in_(set(blobs.values())))
+            btext = dict(query.all())
+            for rid, hash in blobs.items():
+                texts[rid] = btext[hash]
+                self.texts.set((rid, hash), btext[hash])
+
+        # apply deltas from the whole end of each chain back
+        def resolve(rid):
+            chain, r = [], rid
+            while r not in texts:
+                chain.append(r)
+                r = bases[r][0]
+            for r in reversed(chain):
+                texts[r] = apply_delta(texts[bases[r][0]], bases[r][1])
+                self.texts.set((r, hashes[r]), texts[r])
+            return texts[rid]
+
+        # loaded objects now hold full text, so drop their base too
+        for p in stored:
+            set_committed_value(p, 'text', resolve(p.rid))
+            set_committed_value(p, 'base', None)
+
+        return paras
+
+    # move whole texts of rows matching cond to the blob table, if enabled
+    def blob_store(self, cond):
+        if not self.dedup:
+            return
+        whole = and_(cond, Paragraph.base == None, Paragraph.text != '')
+        self.session.execute(
+            insert(Blob)
+            .from_select(['hash', 'text'], select(Paragraph.hash, Paragraph.text).where(whole))
+            .prefix_with('OR IGNORE')
+        )
+        self.session.execute(
+            update(Paragraph)
+            .where(whole)
+            .values(text='')
+            .execution_options(synchronize_session=False)
+        )
+
+    # drop blobs that no revision refers to
+    def prune_blobs(self):
+        used = select(Paragraph.hash).where(Paragraph.text == '', Paragraph.hash != None)
+        return self.session.execute(
+            delete(Blob)
+            .where(Blob.hash.notin_(used))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+    # store full text for revisions chained onto those matching cond, before they go
+    def materialize(self, cond):
+        doomed = select(Paragraph.rid).where(cond)
+        deps = self.session.query(Paragraph).filter(Paragraph.base.in_(doomed)).all()
+        if len(deps) == 0:
+            return
+        self.expand_paras(deps)
+        self.session.execute(
+            update(Paragraph)
+            .where(Paragraph.rid == bindparam('r'))
+            .values(text=bindparam('x'), base=None),
+            [dict(r=p.rid, x=p.text) for p in deps]
+        )
+        self.session.expire_all()
+
+    # store full text for delta and blob revisions matching cond, as they come back to life
+    def inline(self, cond):
+        stored = or_(Paragraph.base != None, and_(Paragraph.text == '', Paragraph.hash != empty_hash))
+        paras = self.session.query(Paragraph).filter(cond, stored).all()
+        if len(paras) == 0:
+            return
+        self.expand_paras(paras)
+        self.session.execute(
+            update(Paragraph)
+            .where(Paragraph.rid == bindparam('r'))
+            .values(text=bindparam('x'), base=None),
+            [dict(r=p.rid, x=p.text) for p in paras]
+        )
+        self.session.expire_all()
+
+    ##
+    ## edit journal
+    ##
+
+    def journal(self, aid, time, kind, pids):
+        if kind != 'move':
+            self.enqueue_index(pids)
+        pids = ' '.join(str(p) for p in pids)
+        self.session.add(Journal(aid=aid, time=time, kind=kind, pids=pids))
+
+        # snapshot every so often so old states replay from nearby
+        self.edits[aid] += 1
+        if self.edits[aid] >= self.checkpoint_every:
+            self.checkpoint(aid, time)
+
+    ##
+    ## checkpoints
+    ##
+
+    # store the current state of an article as of time, called before commit
+    def checkpoint(self, aid, time):
+        rows = (self.session
+            .query(ParalinkHead.pid, ParagraphHead.rid, ParalinkHead.lid)
+            .join(ParagraphHead, ParagraphHead.pid == ParalinkHead.pid)
+            .filter(ParalinkHead.aid == aid)
+            .order_by(ParalinkHead.rank)
+            .all()
+        )
+        pids, rids, lids = zip(*rows) if len(rows) > 0 else ([], [], [])
+        self.session.add(Checkpoint(
+            aid=aid, time=time, pids=json.dumps(pids), rids=json.dumps(rids),
+            lids=json.dumps(lids)
+        ))
+        self.edits[aid] = 0
+
+    def get_checkpoint(self, aid, time):
+        return (self.session
+            .query(Checkpoint)
+            .filter(Checkpoint.aid == aid, Checkpoint.time <= time)
+            .order_by(Checkpoint.time.desc())
+            .first()
+        )
+
+    # rows alive at time: those in the nearest checkpoint plus the ones created after it
+    def hist_filter(self, klass, time, aid):
+        if (chk := self.get_checkpoint(aid, time)) is None:
+            return and_(klass.aid == aid, intime(time, klass))
+        key, ids = (klass.rid, chk.rids) if klass is Paragraph else (klass.lid, chk.lids)
+        base = func.json_each(ids).table_valued('value')
+        newer = select(key).where(
+            klass.aid == aid, klass.create_time > chk.time, klass.create_time <= time
+        )
+        return and_(
+            key.in_(union(select(base.c.value), newer)),
+            or_(klass.delete_time == None, klass.delete_time > time),
+        )
+
+    # derive journal entries from the revision times of older databases
+    def backfill_journal(self):
+        times = union(*[
+            select(klass.aid, col.label('time')).where(col != None)
+            for klass in (Paragraph, Paralink)
+            for col in (klass.create_time, klass.delete_time)
+        ]).subquery()
+        self.session.execute(
+            insert(Journal).from_select(
+                ['aid', 'time', 'kind'],
+                select(times.c.aid, times.c.time, literal('legacy'))
+            )
+        )
+        self.session.commit()
+
     ##
     ## editing methods
     ##
 
-    def create_pid(self):
-        pmax = self.session.query(func.max(Paragraph.pid)).scalar()
-        return pmax + 1 if pmax is not None else 0
+    def create_pid(self, n=1):
+        if self.pids is None:
+            with self.pid_lock:
+                if self.pids is None:
+                    pmax = self.session.query(func.max(Paragraph.pid)).scalar()
+                    self.pids = IdAllocator(pmax + 1 if pmax is not None else 0)
+        return self.pids.take(n)
+
+    def create_pids(self, n):
+        start = self.create_pid(n)
+        return list(range(start, start + n))
 
     def update_para(self, pid, text, time=None):
         if time is None:
             time = datetime.utcnow()
 
-        if (par := self.get_para(pid, time=time)) is None:
+        if (par := self.get_para(pid)) is None:
+            return
+
+        # unchanged text makes no new revision
+        if par.hash is not None and par.hash == text_hash(text):
             return
 
         par.delete_time = time
@@ -530,32 +1141,82 @@ class ElltwoDB:
 
         par1 = Paragraph(aid=par.aid, pid=par.pid, create_time=time, text=text)
         self.session.add(par1)
+        self.delta_encode([par])
 
+        self.journal(par.aid, time, 'update', [pid])
         self.session.commit()
 
     def bulk_update(self, para_dict, time=None):
         if time is None:
             time = datetime.utcnow()
 
-        for pid, text in para_dict.items():
-            self.update_para(pid, text, time=time)
+        if len(para_dict) == 0:
+            return []
+
+        # current revisions of all targets at once
+        revs = (self
+            .para_query()
+            .filter(ParagraphHead.pid.in_(para_dict))
+            .with_entities(
+                Paragraph.rid, Paragraph.pid, Paragraph.aid, Paragraph.text, Paragraph.hash,
+                Paragraph.depth
+            )
+            .all()
+        )
+
+        # skip those whose text is unchanged
+        revs = [r for r in revs if r.hash is None or r.hash != text_hash(para_dict[r.pid])]
+        if len(revs) == 0:
+            return []
+
+        # close old revisions
+        (self.session
+            .query(Paragraph)
+            .filter(Paragraph.rid.in_([r.rid for r in revs]))
+            .update({Paragraph.delete_time: time}, synchronize_session=False)
+        )
+
+        # open new revisions
+        self.session.execute(insert(Paragraph), [
+            dict(aid=r.aid, pid=r.pid, text=para_dict[r.pid], create_time=time) for r in revs
+        ])
+        self.delta_encode(revs)
+
+        # touch each article once
+        arts = defaultdict(list)
+        for r in revs:
+            arts[r.aid].append(r.pid)
+        (self.session
+            .query(Article)
+            .filter(Article.aid.in_(arts))
+            .update({Article.last_edit: time}, synchronize_session=False)
+        )
+        for aid, pids in arts.items():
+            self.journal(aid, time, 'update', pids)
+
+        self.session.commit()
+
+        return [r.pid for r in revs]
 
     def insert_after(self, pid, text='', time=None, commit=True):
         if time is None:
             time = datetime.utcnow()
 
-        if (par := self.get_para(pid, time=time)) is None:
+        if (par := self.get_para(pid)) is None:
             return
-        if (lin := self.get_link(pid, time=time)) is None:
+        if (lin := self.get_link(pid)) is None:
             return
 
-        linn = self.get_link(lin.next, time=time)
+        linn = self.get_link(lin.next)
+        rank, = self.link_ranks(par.aid, lin, linn)
 
         pid1 = self.create_pid()
         par1 = Paragraph(aid=par.aid, pid=pid1, text=text, create_time=time)
         self.session.add(par1)
 
-        lin0 = Paralink(aid=par.aid, pid=par1.pid, prev=pid, next=lin.next, create_time=time)
+        lin0 = Paralink(
+            aid=par.aid, pid=par1.pid, prev=pid, next=lin.next, rank=rank, create_time=time
+        )
         self.session.add(lin0)
 
         lin1 = splice_link(lin, time, next=par1.pid)
@@ -565,27 +1226,34 @@ class ElltwoDB:
             linn1 = splice_link(linn, time, prev=par1.pid)
             self.session.add(linn1)
 
+        self.journal(par.aid, time, 'insert', [pid1])
+
         if commit:
             self.session.commit()
 
+        self.order_insert(par.aid, pid, [pid1], after=True)
+
         return par1
 
     def insert_before(self, pid, text='', time=None, commit=True):
         if time is None:
             time = datetime.utcnow()
 
-        if (par := self.get_para(pid, time=time)) is None:
+        if (par := self.get_para(pid)) is None:
             return
-        if (lin := self.get_link(pid, time=time)) is None:
+        if (lin := self.get_link(pid)) is None:
             return
 
-        linp = self.get_link(lin.prev, time=time)
+        linp = self.get_link(lin.prev)
+        rank, = self.link_ranks(par.aid, linp, lin)
 
         pid1 = self.create_pid()
         par1 = Paragraph(aid=par.aid, pid=pid1, text=text, create_time=time)
         self.session.add(par1)
 
-        lin0 = Paralink(aid=par.aid, pid=par1.pid, prev=lin.prev, next=pid, create_time=time)
+        lin0 = Paralink(
+            aid=par.aid, pid=par1.pid, prev=lin.prev, next=pid, rank=rank, create_time=time
+        )
         self.session.add(lin0)
 
         lin1 = splice_link(lin, time, prev=par1.pid)
@@ -595,115 +1263,209 @@ class ElltwoDB:
             linp1 = splice_link(linp, time, next=par1.pid)
             self.session.add(linp1)
 
+        self.journal(par.aid, time, 'insert', [pid1])
+
         if commit:
             self.session.commit()
 
+        self.order_insert(par.aid, pid, [pid1], after=False)
+
         return par1
 
     def move_para(self, aid, drag_pid, targ_pid, time=None):
+        return self.move_paras(aid, drag_pid, drag_pid, targ_pid, time=time)
 
+    # move the run first_pid..last_pid to just after targ_pid
+    def move_paras(self, aid, first_pid, last_pid, targ_pid, time=None):
         if time is None:
             time = datetime.utcnow()
 
-        ## delete links associated with inital drag pos 
-        if (drag_lin := self.get_link(drag_pid, time=time)) is None:
+        order = self.get_pids(aid)
+        if first_pid not in order or last_pid not in order or targ_pid not in order:
             return
-
-        d_linp = self.get_link(drag_lin.prev, time)
-        d_linn = self.get_link(drag_lin.next, time)
-
-        #splice
-        if d_linp is not None:
-            d_linp1 = splice_link(d_linp, time, next=drag_lin.next)
-            self.session.add(d_linp1)
-        if d_linn is not None:
-            d_linn1 = splice_link(d_linn, time, prev=drag_lin.prev)
-            self.session.add(d_linn1)
-
-        #commit (drag para is now unlinked)
-        self.session.commit()
-
-
-        #insert dragged para after target
-        if (targ_lin := self.get_link(targ_pid, time=time)) is None:
+        i, j = order.index(first_pid), order.index(last_pid)
+        if i > j:
+            return
+        block = order[i:j+1]
+        if targ_pid in block:
             return
 
-        t_linn = self.get_link(targ_lin.next, time)
+        # neighbors before and after the move
+        before = order[i-1] if i > 0 else None
+        after = order[j+1] if j + 1 < len(order) else None
+        if targ_pid == before:
+            return True
+        rest = order[:i] + order[j+1:]
+        k = rest.index(targ_pid)
+        tnext = rest[k+1] if k + 1 < len(rest) else None
+
+        # boundary pointer changes, merged per link
+        change = defaultdict(dict)
+        if before is not None:
+            change[before]['next'] = after
+        if after is not None:
+            change[after]['prev'] = before
+        change[first_pid]['prev'] = targ_pid
+        change[last_pid]['next'] = tnext
+        change[targ_pid]['next'] = first_pid
+        if tnext is not None:
+            change[tnext]['prev'] = last_pid
+
+        # get affected links and new ranks for the block
+        needed = set(block) | set(change)
+        links = {
+            lin.pid: lin for lin in self.link_query(aid=aid).filter(Paralink.pid.in_(needed)).all()
+        }
+        ranks = self.link_ranks(aid, links[targ_pid], links.get(tnext), n=len(block))
+        ranks = dict(zip(block, ranks))
 
-        d_lin1 = splice_link(drag_lin, time, prev=targ_pid, next=targ_lin.next)
-        t_lin1 = splice_link(targ_lin, time, next=drag_pid)
-        self.session.add(t_lin1)
-        self.session.add(d_lin1)
+        # interior links only shift position
+        for pid in block:
+            if pid not in change:
+                links[pid].rank = ranks[pid]
+            else:
+                change[pid]['rank'] = ranks[pid]
 
-        ##clean up next para link 
-        if t_linn is not None:
-            linn1 = splice_link(t_linn, time, prev=drag_pid)
-            self.session.add(linn1)
+        for pid, kwargs in change.items():
+            self.session.add(splice_link(links[pid], time, **kwargs))
 
+        self.journal(aid, time, 'move', block)
         self.session.commit()
-        return True
+        self.order.set(aid, rest[:k+1] + block + rest[k+1:])
 
+        return True
 
+    # write a block of new paragraphs between two current links (None at the ends)
+    def insert_block(self, aid, texts, prev=None, next=None, time=None):
+        if time is None:
+            time = datetime.utcnow()
 
-    def paste_after(self, pid, adds, time=None):
+        n_par = len(texts)
+        ranks = self.link_ranks(aid, prev, next, n=n_par)
+        pids = self.create_pids(n_par)
+        links = [
+            prev.pid if prev is not None else None, *pids,
+            next.pid if next is not None else None
+        ]
+
+        self.session.execute(insert(Paragraph), [
+            dict(aid=aid, pid=pid, text=text, create_time=time)
+            for pid, text in zip(pids, texts)
+        ])
+        self.session.execute(insert(Paralink), [
+            dict(aid=aid, pid=pid, prev=links[i], next=links[i+2], rank=rank, create_time=time)
+            for i, (pid, rank) in enumerate(zip(pids, ranks))
+        ])
+
+        # only the boundary links change
+        if prev is not None:
+            self.session.add(splice_link(prev, time, next=pids[0]))
+        if next is not None:
+            self.session.add(splice_link(next, time, prev=pids[-1]))
+
+        return pids
+
+    def splice_paras(self, pid, texts, after=True, time=None, commit=True):
         if time is None:
             time = datetime.utcnow()
 
-        if (par := self.get_para(pid, time=time)) is None:
+        if len(texts) == 0:
+            return []
+        if (lin := self.get_link(pid)) is None:
             return
 
-        pid_map = []
-        pid_cur = pid
-        for raw in adds:
-            new_para = self.insert_after(pid_cur, raw, time=time, commit=False)
-            pid_map.append([new_para.pid, raw])
-            pid_cur = new_para.pid
+        if after:
+            prev, next = lin, self.get_link(lin.next)
+        else:
+            prev, next = self.get_link(lin.prev), lin
 
-        self.session.commit()
+        pids = self.insert_block(lin.aid, texts, prev=prev, next=next, time=time)
+        self.journal(lin.aid, time, 'insert', pids)
 
-        return pid_map
+        if commit:
+            self.session.commit()
 
-    def delete_para(self, pid, time=None, commit=True):
-        if time is None:
-            time = datetime.utcnow()
+        self.order_insert(lin.aid, pid, pids, after=after)
 
-        if (par := self.get_para(pid, time=time)) is None:
-            return
-        if (lin := self.get_link(pid, time=time)) is None:
+        return pids
+
+    def paste_after(self, pid, adds, time=None):
+        if (pids := self.splice_paras(pid, adds, after=True, time=time)) is None:
             return
+        return [[pid1, raw] for pid1, raw in zip(pids, adds)]
 
-        linp = self.get_link(lin.prev, time)
-        linn = self.get_link(lin.next, time)
+    def delete_para(self, pid, time=None, commit=True):
+        return self.delete_paras([pid], time=time, commit=commit)
 
-        par.delete_time = time
-        lin.delete_time = time
+    def delete_paras(self, pids, time=None, commit=True):
+        if time is None:
+            time = datetime.utcnow()
 
-        if linp is not None:
-            linp1 = splice_link(linp, time, next=lin.next)
-            self.session.add(linp1)
-        if linn is not None:
-            linn1 = splice_link(linn, time, prev=lin.prev)
-            self.session.add(linn1)
+        heads = (self.session
+            .query(ParagraphHead.pid, ParagraphHead.aid)
+            .filter(ParagraphHead.pid.in_(pids))
+            .all()
+        )
+        arts = defaultdict(set)
+        for h in heads:
+            arts[h.aid].add(h.pid)
+
+        for aid, drop in arts.items():
+            # reconnect the survivors around each deleted run
+            order = self.get_pids(aid)
+            keep = [pid for pid in order if pid not in drop]
+            change = defaultdict(dict)
+            for prev, next in zip([None, *order], [*order, None]):
+                if (prev in drop) == (next in drop):
+                    continue
+                if prev in drop:
+                    tail = next
+                else:
+                    head = prev
+                    continue
+                if head is not None:
+                    change[head]['next'] = tail
+                if tail is not None:
+                    change[tail]['prev'] = head
+
+            links = self.link_query(aid=aid).filter(Paralink.pid.in_(change)).all()
+            for lin in links:
+                self.session.add(splice_link(lin, time, **change[lin.pid]))
+
+            # close the deleted rows in bulk
+            for klass in (Paragraph, Paralink):
+                (self.session
+                    .query(klass)
+                    .filter(klass.pid.in_(drop))
+                    .filter(klass.delete_time == None)
+                    .update({klass.delete_time: time}, synchronize_session=False)
+                )
+            self.blob_store(and_(Paragraph.pid.in_(drop), Paragraph.delete_time == time))
+
+            self.order.set(aid, keep)
+            self.journal(aid, time, 'delete', [pid for pid in order if pid in drop])
 
         if commit:
             self.session.commit()
 
-    def delete_paras(self, pids, time=None):
-        if time is None:
-            time = datetime.utcnow()
-        for p in pids:
-            self.delete_para(p, time=time, commit=False)
-        self.session.commit()
+        return [h.pid for h in heads]
+
+    def delete_range(self, aid, first_pid, last_pid, time=None):
+        order = self.get_pids(aid)
+        if first_pid not in order or last_pid not in order:
+            return
+        i, j = order.index(first_pid), order.index(last_pid)
+        return self.delete_paras(order[i:j+1], time=time)
 
     ##
     ## article methods
     ##
 
     def first_para(self, aid):
-        return self.session.query(Paralink).filter_by(aid=aid).filter_by(prev=None).one_or_none()
+        return self.link_query(aid=aid).filter(Paralink.prev == None).one_or_none()
 
     def last_para(self, aid):
-        return self.session.query(Paralink).filter_by(aid=aid).filter_by(next=None).one_or_none()
+        return self.link_query(aid=aid).filter(Paralink.next == None).one_or_none()
 
     def create_article(self, title, short_title=None, init=True, time=None, g_ref=False, index=True):
         if time is None:
@@ -724,7 +1486,7 @@ class ElltwoDB:
             self.init_article(art.aid, text=f'#! {title}', time=time)
 
         if index:
-            self.index_document('title', art.aid, title)
+            self.index_title(art.aid, art.title, art.short_title)
 
         return art
 
@@ -742,7 +1504,7 @@ class ElltwoDB:
         if (art := self.get_art(aid)) is None:
             return False
         art.title = title
-        self.index_document('title', aid, title, clear=True, commit=False)
+        self.index_title(aid, title, art.short_title, commit=False)
         self.session.commit()
 
     def delete_article(self, aid, time=None):
@@ -752,13 +1514,14 @@ class ElltwoDB:
             art.delete_time = time
             self.unindex_document('title', art.aid, commit=False)
             self.session.commit()
+            self.order.pop(aid)
 
     def undelete_article(self, aid, time=None):
         if time is None:
             time = datetime.utcnow()
         if (art := self.get_art(aid, all=True)) is not None:
             art.delete_time = None
-            self.index_document('title', art.aid, art.title, commit=False)
+            self.index_title(art.aid, art.title, art.short_title, commit=False)
             self.session.commit()
 
     def init_article(self, aid, text, time=None):
@@ -767,11 +1530,14 @@ class ElltwoDB:
 
         pid = self.create_pid()
         par = Paragraph(aid=aid, pid=pid, text=text, create_time=time)
-        lin = Paralink(aid=aid, pid=pid, prev=None, next=None, create_time=time)
+        lin = Paralink(aid=aid, pid=pid, prev=None, next=None, rank=rank_gap, create_time=time)
 
         self.session.add_all([par, lin])
+        self.journal(aid, time, 'create', [pid])
         self.session.commit()
 
+        self.order.set(aid, [pid])
+
     def insert_begin(self, aid, text, time=None):
         if time is None:
             time = datetime.utcnow()
@@ -813,19 +1579,14 @@ class ElltwoDB:
         aid = art.aid
 
         paras = re.sub(r'\n{3,}', '\n\n', mark).strip('\n').split('\n\n')
-        n_par, max_pid = len(paras), self.create_pid()
-        pids = list(range(max_pid, max_pid + n_par))
-
-        for i, (pid, ptxt) in enumerate(zip(pids, paras)):
-            prev = None if i == 0 else pids[i-1]
-            next = None if i == n_par - 1 else pids[i+1]
-            par = Paragraph(aid=aid, pid=pid, text=ptxt, create_time=time)
-            lin = Paralink(aid=aid, pid=pid, prev=prev, next=next, create_time=time)
-            self.session.add_all([par, lin])
+        pids = self.insert_block(aid, paras, time=time)
+        self.journal(aid, time, 'create', pids)
 
         if commit or index:
             self.session.commit()
 
+        self.order.set(aid, pids)
+
         if index:
             self.reindex_article(art.aid)
 
@@ -1047,6 +1808,7 @@ class ElltwoDB:
         )
         self.session.add(tag)
         self.session.commit()
+        self.results.clear()
 
     def delete_tag(self, aid, tag, time=None):
         if time is None:
@@ -1058,6 +1820,7 @@ class ElltwoDB:
         tag.delete_time = time
         self.session.add(tag)
         self.session.commit()
+        self.results.clear()
 
     ##
     ## storing images
@@ -1131,63 +1894,53 @@ class ElltwoDB:
     ## getting differentials
     ##
 
-    def get_commits(self, aid=None, klass=None):
-        if klass is None:
-            return sorted(set(
-                self.get_commits(aid=aid, klass=Paragraph)
-              + self.get_commits(aid=aid, klass=Paralink)
-            ))
-        cond = {'aid': aid} if aid is not None else {}
-        paras = self.session.query(klass).filter_by(**cond)
-        times = (
-            paras.from_self(distinct(klass.create_time)).all()
-          + paras.from_self(distinct(klass.delete_time)).all()
+    # commit times in order, pages are counted back from the latest
+    def get_commits(self, aid=None, offset=0, limit=None):
+        query = self.session.query(Journal.time).distinct()
+        if aid is not None:
+            query = query.filter(Journal.aid == aid)
+        query = query.order_by(Journal.time.desc()).offset(offset).limit(limit)
+        return [t for t, in reversed(query.all())]
+
+    # rows whose liveness differs between the two times, with liveness at each
+    def changed_query(self, klass, aid, time2, time1=None):
+        # kept flat so each branch gets its own index search
+        span = [
+            and_(klass.aid == aid, cond)
+            for col in (klass.create_time, klass.delete_time)
+            for cond in between_times(col, time1, time2)
+        ]
+        return (self.session
+            .query(klass, intime(time1, klass).label('alive1'), intime(time2, klass).label('alive2'))
+            .filter(or_(*span))
         )
-        return sorted({t for t, in times} - {None})
 
-    # diff 1 → 2
+    # diff 1 → 2, cost scales with the number of edits in between
     def diff_article(self, aid, time2, time1=None):
-        if time1 is None:
-            time1 = datetime.utcnow()
-
-        # get paragraphs
-        paras1 = self.get_paras(aid, time=time1)
-        paras2 = self.get_paras(aid, time=time2)
-        pids1 = set(p.pid for p in paras1)
-        pids2 = set(p.pid for p in paras2)
-
-        # get paralinks
-        links1 = self.get_links(aid, time=time1)
-        links2 = self.get_links(aid, time=time2)
-        lids1 = set(l.lid for l in links1)
-        lids2 = set(l.lid for l in links2)
-
-        # get added paras
-        pid_add = list(pids2 - pids1)
-        para_add = {p.pid: p.text for p in paras2 if p.pid in pid_add}
-
-        # get deleted paras
-        pid_del = list(pids1 - pids2)
-
-        # get updated paras
-        pid_com = list(pids1 & pids2)
-        para1_com = sorted([p for p in paras1 if p.pid in pid_com], key=lambda x: x.pid)
-        para2_com = sorted([p for p in paras2 if p.pid in pid_com], key=lambda x: x.pid)
-        para_upd = {p2.pid: p2.text for p1, p2 in zip(para1_com, para2_com) if p1.rid != p2.rid}
-
-        # get added paralinks
-        lid_add = list(lids2 - lids1)
-        link_add = {l.lid: (l.pid, l.prev, l.next) for l in links2 if l.lid in lid_add}
+        # a pid changed in between has no unchanged revision live at either time
+        paras = self.changed_query(Paragraph, aid, time2, time1).all()
+        hash1 = {p.pid: p.hash for p, a1, _ in paras if a1}
+        para2 = {p.pid: p for p, _, a2 in paras if a2}
+
+        # revisions with identical text are not updates, hashes settle that
+        pid_add = para2.keys() - hash1.keys()
+        pid_upd = {
+            pid for pid in para2.keys() & hash1.keys()
+            if (h := para2[pid].hash) is None or h != hash1[pid]
+        }
+        self.expand_paras([para2[pid] for pid in pid_add | pid_upd])
 
-        # get deleted paralinks
-        lid_del = list(lids1 - lids2)
+        # likewise for links, which are only ever replaced whole
+        links = self.changed_query(Paralink, aid, time2, time1).all()
+        lids1 = {l.lid for l, a1, _ in links if a1}
+        link2 = {l.lid: (l.pid, l.prev, l.next) for l, _, a2 in links if a2}
 
         return {
-            'para_add': para_add,
-            'para_upd': para_upd,
-            'para_del': pid_del,
-            'link_add': link_add,
-            'link_del': lid_del,
+            'para_add': {pid: para2[pid].text for pid in pid_add},
+            'para_upd': {pid: para2[pid].text for pid in pid_upd},
+            'para_del': list(hash1.keys() - para2.keys()),
+            'link_add': {lid: link2[lid] for lid in link2.keys() - lids1},
+            'link_del': list(lids1 - link2.keys()),
         }
 
     def revert_article(self, aid, time0=None, time1=None, diff=None):
@@ -1200,36 +1953,155 @@ class ElltwoDB:
         if diff is None:
             diff = self.diff_article(aid, time, time1)
 
-        # insert new paras
-        for pid, text in diff['para_add'].items():
-            par = Paragraph(aid=aid, pid=pid, text=text, create_time=time)
-            self.session.add(par)
-
-        # update existing paras (delete old revision, add new revision)
-        for pid, text in diff['para_upd'].items():
-            rev = self.get_para(pid, time=time)
-            rev.delete_time = time
-            par = Paragraph(aid=aid, pid=pid, text=text, create_time=time)
-            self.session.add(par)
-
-        # delete old paras
-        for pid in diff['para_del']:
-            par = self.get_para(pid, time=time)
-            par.delete_time = time
-
-        # add new links
-        for lid, (pid, prv, nxt) in diff['link_add'].items():
-            lin = Paralink(aid=aid, pid=pid, prev=prv, next=nxt, create_time=time)
-            self.session.add(lin)
-
-        # delete old links
-        for lid in diff['link_del']:
-            lin = self.get_lid(lid) # primary key
-            lin.delete_time = time
+        # updated paragraphs become deltas once replaced
+        if self.keyframe is not None:
+            revs = (self
+                .para_query()
+                .filter(ParagraphHead.pid.in_(diff['para_upd']))
+                .with_entities(Paragraph.rid, Paragraph.pid, Paragraph.text, Paragraph.depth)
+                .all()
+            )
+        else:
+            revs = []
+
+        # close superseded paragraph revisions
+        (self.session
+            .query(Paragraph)
+            .filter(
+                Paragraph.pid.in_([*diff['para_upd'], *diff['para_del']]),
+                Paragraph.delete_time == None
+            )
+            .update({Paragraph.delete_time: time}, synchronize_session=False)
+        )
+
+        # close old links
+        (self.session
+            .query(Paralink)
+            .filter(Paralink.lid.in_(diff['link_del']))
+            .update({Paralink.delete_time: time}, synchronize_session=False)
+        )
+
+        # insert new and updated paras
+        paras = diff['para_add'] | diff['para_upd']
+        if len(paras) > 0:
+            self.session.execute(insert(Paragraph), [
+                dict(aid=aid, pid=pid, text=text, create_time=time)
+                for pid, text in paras.items()
+            ])
+        self.delta_encode(revs)
+
+        # whatever was closed and stays whole goes to the blob table
+        self.blob_store(and_(
+            Paragraph.pid.in_([*diff['para_upd'], *diff['para_del']]),
+            Paragraph.delete_time == time
+        ))
+
+        # insert new links
+        if len(diff['link_add']) > 0:
+            self.session.execute(insert(Paralink), [
+                dict(aid=aid, pid=pid, prev=prv, next=nxt, create_time=time)
+                for pid, prv, nxt in diff['link_add'].values()
+            ])
+
+        # links were replaced wholesale, recompute positions
+        self.rerank(aid)
+
+        # record every paragraph touched
+        pids = [*diff['para_add'], *diff['para_upd'], *diff['para_del']]
+        self.journal(aid, time, 'revert', pids)
 
         # commit it all
         self.session.commit()
 
+        # edits for clients to apply
+        return {
+            'para_add': diff['para_add'],
+            'para_del': diff['para_del'],
+            'para_upd': diff['para_upd'],
+            'position': order_links(diff['link_add']),
+        }
+
+    ##
+    ## history compaction
+    ##
+
+    # snap revisions before horizon to the last commit of their bucket, dropping
+    # those that were never live at a retained commit
+    def compact_history(self, horizon, granularity='hour', aid=None):
+        if isinstance(granularity, str):
+            granularity = time_grains[granularity]
+
+        # commit times per article
+        query = self.session.query(Journal.aid, Journal.time).filter(Journal.time < horizon)
+        if aid is not None:
+            query = query.filter(Journal.aid == aid)
+        times = defaultdict(set)
+        for a, t in query.all():
+            times[a].add(t)
+
+        dropped = defaultdict(int)
+        for a, ts in times.items():
+            # every time moves forward to the last one in its bucket
+            keep = {}
+            for t in sorted(ts):
+                keep[time_bucket(t, granularity)] = t
+            snap = [
+                dict(a=a, t=t, r=r) for t in ts
+                if (r := keep[time_bucket(t, granularity)]) != t
+            ]
+            if len(snap) == 0:
+                continue
+
+            # rows created and deleted within one bucket are now empty
+            for klass in (Paragraph, Paralink):
+                for col in (klass.create_time, klass.delete_time):
+                    self.session.execute(
+                        update(klass)
+                        .where(klass.aid == bindparam('a'), col == bindparam('t'))
+                        .values({col: bindparam('r')}),
+                        snap
+                    )
+                empty = and_(
+                    klass.aid == a,
+                    klass.delete_time != None,
+                    klass.create_time >= klass.delete_time
+                )
+                if klass is Paragraph:
+                    self.materialize(empty)
+                dropped[klass.__tablename__] += (self.session
+                    .query(klass)
+                    .filter(empty)
+                    .delete(synchronize_session=False)
+                )
+
+            # forget merged commits, checkpoints at retained ones are still valid
+            for klass in (Journal, Checkpoint):
+                dropped[klass.__tablename__] += self.session.execute(
+                    delete(klass)
+                    .where(klass.aid == bindparam('a'), klass.time == bindparam('t')),
+                    snap
+                ).rowcount
+
+        dropped['blob'] = self.prune_blobs()
+        self.session.commit()
+        self.texts.clear()
+
+        return dict(dropped)
+
+    # reclaim free pages, returns database size before and after
+    def vacuum(self):
+        def db_size(con):
+            pages, = con.exec_driver_sql('PRAGMA page_count').one()
+            size, = con.exec_driver_sql('PRAGMA page_size').one()
+            return pages*size
+        self.session.close()
+        with self.engine.connect() as con:
+            con = con.execution_options(isolation_level='AUTOCOMMIT')
+            size0 = db_size(con)
+            con.exec_driver_sql('VACUUM')
+            size1 = db_size(con)
+        return size0, size1
+
     ##
     ## user manager
     ##
@@ -1282,76 +2154,567 @@ class ElltwoDB:
     ## index interface
     ##
 
+    # word ids for a set of words, adding unseen ones to the vocabulary
+    def word_ids(self, words):
+        wids = dict(self.session
+            .query(IndexWord.word, IndexWord.wid)
+            .filter(IndexWord.word.in_(words))
+            .all()
+        )
+        if len(new := [w for w in words if w not in wids]) > 0:
+            self.session.execute(insert(IndexWord), [dict(word=w) for w in new])
+            wids |= dict(self.session
+                .query(IndexWord.word, IndexWord.wid)
+                .filter(IndexWord.word.in_(new))
+                .all()
+            )
+            self.session.execute(insert(IndexGram), [
+                dict(wid=wids[w], text=tok, pos=pos, count=cnt)
+                for w, shard in shardify_words(new) for tok, (pos, cnt) in shard.items()
+            ])
+        return wids
+
+    # old words are pruned once the new ones are in, so shared ones are kept
     def index_document(self, dtype, ident, text, clear=False, commit=True):
         if clear:
-            self.unindex_document(dtype, ident, commit=False)
-        for wid, shards in shardify_document(text).items():
-            for tok, pos in shards:
-                ent = TextShard(
-                    text=tok, word_idx=wid, word_pos=pos,
-                    source_type=dtype, source_id=ident
-                )
-                self.session.add(ent)
+            old = self.unindex_document(dtype, ident, commit=False, prune=False)
+        words = text.lower().split()
+        if len(words) > 0:
+            wids = self.word_ids(set(words))
+            self.session.execute(insert(WordPost), [
+                dict(wid=wids[w], word_idx=i, source_type=dtype, source_id=ident)
+                for i, w in enumerate(words)
+            ])
+        if clear:
+            self.prune_words(old)
+        if self.memory_writable():
+            self.memory_update(dtype, ident, words, clear=clear)
+        if self.fts and dtype == 'para':
+            con = self.session.connection()
+            con.exec_driver_sql(f'DELETE FROM {fts_table} WHERE rowid = ?', (ident,))
+            con.exec_driver_sql(f'INSERT INTO {fts_table} (rowid, text) VALUES (?, ?)', (ident, text))
+        self.bump_index()
         if commit:
             self.session.commit()
 
-    def unindex_document(self, dtype, ident, commit=True):
-        query = self.session.query(TextShard).filter_by(
+    # returns the word ids the document used
+    def unindex_document(self, dtype, ident, commit=True, prune=True):
+        query = self.session.query(WordPost).filter_by(
             source_type=dtype, source_id=ident
         )
+        wids = [w for w, in query.with_entities(WordPost.wid.distinct()).all()]
         query.delete()
+        if prune:
+            self.prune_words(wids)
+        if self.memory_writable():
+            self.memory.remove(dtype, ident)
+        if self.fts and dtype == 'para':
+            self.session.connection().exec_driver_sql(
+                f'DELETE FROM {fts_table} WHERE rowid = ?', (ident,)
+            )
+        self.bump_index()
         if commit:
             self.session.commit()
+        return wids
+
+    # drop words, and their trigrams, that no document uses any more
+    def prune_words(self, wids=None):
+        orphan = ~exists().where(WordPost.wid == IndexWord.wid)
+        if wids is not None:
+            if len(wids) == 0:
+                return
+            orphan = and_(IndexWord.wid.in_(wids), orphan)
+        self.session.execute(
+            delete(IndexGram)
+            .where(IndexGram.wid.in_(select(IndexWord.wid).where(orphan)))
+            .execution_options(synchronize_session=False)
+        )
+        self.session.execute(
+            delete(IndexWord)
+            .where(orphan)
+            .execution_options(synchronize_session=False)
+        )
 
     def clear_index(self, dtype=None):
-        query = self.session.query(TextShard)
-        if dtype is not None:
-            query = query.filter_by(source_type=dtype)
-        query.delete()
+        if dtype is None:
+            for klass in (WordPost, IndexGram, IndexWord):
+                self.session.query(klass).delete()
+        else:
+            self.session.query(WordPost).filter_by(source_type=dtype).delete()
+            self.prune_words()
+        if self.memory_writable():
+            self.memory.clear(dtype)
+        if self.fts and dtype in (None, 'para'):
+            self.session.connection().exec_driver_sql(f'DELETE FROM {fts_table}')
+        self.bump_index()
+        self.session.commit()
+
+    # fts5 table of paragraph texts, filled from the current ones when first made,
+    # unless this is a new database whose tables are yet to be created
+    def create_fts(self):
+        tables = inspect(self.engine).get_table_names()
+        if fts_table not in tables:
+            con = self.session.connection()
+            con.exec_driver_sql(
+                f"CREATE VIRTUAL TABLE {fts_table} USING fts5(text, tokenize='porter unicode61')"
+            )
+            if Paragraph.__tablename__ in tables:
+                query = self.session.query(Paragraph.pid, Paragraph.text)
+                texts = self.index_paras(query, datetime.utcnow()).all()
+                if len(texts) > 0:
+                    con.exec_driver_sql(
+                        f'INSERT INTO {fts_table} (rowid, text) VALUES (?, ?)', [tuple(r) for r in texts]
+                    )
+            self.session.commit()
+        self.fts = True
+
+    # mark paragraphs for reindexing, repeated edits push the time forward
+    def enqueue_index(self, pids):
+        if len(pids) == 0:
+            return
+        time = datetime.utcnow()
+        self.session.execute(
+            insert(IndexQueue).prefix_with('OR REPLACE'),
+            [dict(pid=pid, time=time) for pid in set(pids)]
+        )
+
+    # index queued paragraphs that have not been edited for delay seconds
+    def flush_index(self, delay=0, limit=None):
+        # the old index is about to be replaced, so wait for the new one
+        if self.index_status['state'] != 'ready':
+            return 0
+
+        cutoff = datetime.utcnow() - timedelta(seconds=delay)
+        query = (self.session
+            .query(IndexQueue.pid)
+            .filter(IndexQueue.time <= cutoff)
+            .order_by(IndexQueue.time)
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        if len(pids := [p for p, in query.all()]) == 0:
+            return 0
+
+        # current texts of live articles, missing ones have been deleted
+        query = self.session.query(Paragraph.pid, Paragraph.text)
+        query = self.index_paras(query, datetime.utcnow()).filter(ParagraphHead.pid.in_(pids))
+        texts = dict(query.all())
+        for pid in pids:
+            if pid in texts:
+                self.index_document('para', pid, texts[pid], clear=True, commit=False)
+            else:
+                self.unindex_document('para', pid, commit=False)
+
+        # anything edited since the cutoff stays queued
+        (self.session
+            .query(IndexQueue)
+            .filter(IndexQueue.pid.in_(pids), IndexQueue.time <= cutoff)
+            .delete(synchronize_session=False)
+        )
         self.session.commit()
 
+        return len(pids)
+
+    # counts changes to the index, saved index files record the count they reflect
+    def index_generation(self):
+        query = self.session.query(Meta.value).filter(Meta.key == 'index_generation')
+        return query.scalar() or 0
+
+    # a background rebuild replaces the memory index and catches up on writes made
+    # meanwhile, so until it is done they only mark the old one stale
+    def memory_writable(self):
+        if self.memory is None:
+            return False
+        if self.index_status['state'] != 'ready':
+            self.memory.generation = None
+            return False
+        return True
+
+    # the memory index takes the new count, unless it had already fallen behind
+    def bump_index(self):
+        stale = self.memory is not None and self.memory.generation != self.index_generation()
+        query = self.session.query(Meta).filter(Meta.key == 'index_generation')
+        if query.update({Meta.value: Meta.value + 1}, synchronize_session=False) == 0:
+            self.session.add(Meta(key='index_generation', value=1))
+        if self.memory is not None:
+            self.memory.generation = None if stale else self.index_generation()
+
+    # reload when another process has moved the index on, or a rollback undid writes
+    # the memory index had already taken, the new one is mapped if it has been saved
+    def sync_memory_index(self):
+        if self.memory is None or self.index_status['state'] != 'ready':
+            return
+        if self.memory.generation != self.index_generation():
+            self.load_memory_index()
+
+    # load postings into a numpy index, updated along with the database one,
+    # an up to date index file is mapped instead
+    def load_memory_index(self):
+        from .search import MemoryIndex
+        generation = self.index_generation()
+        if self.index_file is not None:
+            memory = MemoryIndex.open(self.index_file)
+            if memory is not None and memory.generation == generation:
+                self.memory = memory
+                return
+
+        words = dict(self.session.query(IndexWord.wid, IndexWord.word).all())
+        query = (self.session
+            .query(WordPost.source_type, WordPost.source_id, WordPost.wid, func.count())
+            .group_by(WordPost.source_type, WordPost.source_id, WordPost.wid)
+        )
+        docs = defaultdict(dict)
+        for t, i, wid, num in query.all():
+            docs[(t, i)][words[wid]] = num
+        self.memory = MemoryIndex()
+        self.memory.load(docs)
+        self.memory.generation = generation
+        self.save_memory_index()
+
+    def save_memory_index(self):
+        if self.memory is None or self.index_file is None:
+            return False
+        # only committed state, so no file claims a generation a rollback gives back
+        if self.session.connection().connection.in_transaction:
+            return False
+        if self.memory.generation != self.index_generation():
+            return False
+        return self.memory.save(self.index_file)
+
+    # documents can be indexed in parts (titles), so merge with what is there
+    def memory_update(self, dtype, ident, words, clear=True):
+        counts = defaultdict(int)
+        if not clear:
+            query = (self.session
+                .query(IndexWord.word, func.count())
+                .join(WordPost, WordPost.wid == IndexWord.wid)
+                .filter(WordPost.source_type == dtype, WordPost.source_id == ident)
+                .group_by(IndexWord.word)
+            )
+            counts.update(query.all())
+        else:
+            for w in words:
+                counts[w] += 1
+        self.memory.add(dtype, ident, counts)
+
+    # titles are indexed along with their short form
+    def index_title(self, aid, title, short_title, commit=True):
+        self.index_document('title', aid, title, clear=True, commit=False)
+        self.index_document('title', aid, short_title, commit=commit)
+
+    def sample_words(self, num):
+        query = self.session.query(IndexWord.word).order_by(func.random()).limit(num)
+        return [w for w, in query.all()]
+
     def reindex_article(self, aid, commit=True):
         if (art := self.get_art(aid)) is None:
             return
-        self.index_document('title', art.aid, art.title, clear=True, commit=False)
-        self.index_document('title', art.aid, art.short_title, clear=False, commit=False)
-        for par in self.get_paras(art.aid):
+        self.index_title(art.aid, art.title, art.short_title, commit=False)
+        paras = self.get_paras(art.aid)
+        for par in paras:
             self.index_document('para', par.pid, par.text, clear=True, commit=False)
+        (self.session
+            .query(IndexQueue)
+            .filter(IndexQueue.pid.in_([par.pid for par in paras]))
+            .delete(synchronize_session=False)
+        )
         if commit:
             self.session.commit()
 
-    def reindex_articles(self):
-        self.clear_index()
-        for art in self.get_arts():
-            self.reindex_article(art.aid, commit=False)
+    # (title, short title) of live articles, as they are indexed
+    def index_titles(self, time):
+        return {a.aid: (a.title, a.short_title) for a in self.get_arts(time=time)}
+
+    # current paragraphs of live articles
+    def index_paras(self, query, time):
+        return (query
+            .join(ParagraphHead, ParagraphHead.rid == Paragraph.rid)
+            .join(Article, Article.aid == ParagraphHead.aid)
+            .filter(arttime(time))
+        )
+
+    # rebuild everything into shadow tables with bulk inserts, then swap them in,
+    # progress is called with (stage, done, total) after each chunk
+    def reindex_articles(self, workers=1, chunk=10000, progress=None):
+        start = datetime.utcnow()
         self.session.commit()
 
-    def search_index(self, text, dtype=None):
-        # shardify query
-        shards = {i: shard_compress(s) for i, s in shardify_document(text).items()}
+        # documents as (type, id, text), titles in two parts as in reindex_article,
+        # noting what they were built from to catch up on writes made meanwhile
+        titles = self.index_titles(start)
+        paras = self.session.query(Paragraph.pid, Paragraph.rid, Paragraph.text)
+        paras = self.index_paras(paras, start).all()
+        revs = {pid: rid for pid, rid, _ in paras}
+        docs = [('title', aid, t) for aid, ts in titles.items() for t in ts]
+        docs += [('para', pid, text) for pid, _, text in paras]
+        words = [text.lower().split() for _, _, text in docs]
+        vocab = sorted(set(chain.from_iterable(words)))
+        wids = {w: i+1 for i, w in enumerate(vocab)}
+
+        # empty shadow tables, left over ones are from failed rebuilds
+        tables = [IndexWord.__table__, IndexGram.__table__, WordPost.__table__]
+        meta = MetaData()
+        shadow = [shadow_table(tab, meta) for tab in tables]
+        con = self.session.connection()
+        for tab in reversed(shadow):
+            tab.drop(bind=con, checkfirst=True)
+        for tab in shadow:
+            tab.create(bind=con)
+        word_new, gram_new, post_new = shadow
+        self.session.commit()
+
+        # vocabulary with trigrams, computed in a process pool given workers
+        if workers is None:
+            workers = os.cpu_count()
+        batches = [vocab[i:i+chunk] for i in range(0, len(vocab), chunk)]
+        done = 0
+        for batch in pool_map(shardify_words, batches, workers=workers):
+            con = self.session.connection()
+            bulk_insert(con, word_new, ['wid', 'word'], [(wids[w], w) for w, _ in batch])
+            bulk_insert(con, gram_new, ['wid', 'text', 'pos', 'count'], [
+                (wids[w], tok, pos, cnt) for w, shard in batch for tok, (pos, cnt) in shard.items()
+            ])
+            self.session.commit()
+            done += len(batch)
+            if progress is not None:
+                progress('words', done, len(vocab))
+
+        # word postings of each document
+        for i in range(0, len(docs), chunk):
+            cols = ['wid', 'word_idx', 'source_type', 'source_id']
+            bulk_insert(self.session.connection(), post_new, cols, [
+                (wids[w], j, dtype, ident)
+                for (dtype, ident, _), ws in zip(docs[i:i+chunk], words[i:i+chunk])
+                for j, w in enumerate(ws)
+            ])
+            self.session.commit()
+            if progress is not None:
+                progress('docs', min(i+chunk, len(docs)), len(docs))
+
+        # swap in and index the new tables holding the write lock, pysqlite would
+        # not begin a transaction for the ddl, leaving others to see it half done
+        con = self.session.connection()
+        con.exec_driver_sql('BEGIN IMMEDIATE')
+        for tab in reversed(tables):
+            tab.drop(bind=con)
+        for tab, new in zip(tables, shadow):
+            con.exec_driver_sql(f'ALTER TABLE {new.name} RENAME TO {tab.name}')
+            for idx in tab.indexes:
+                idx.create(bind=con)
+        if self.fts:
+            con.exec_driver_sql(f'DELETE FROM {fts_table}')
+            con.exec_driver_sql(f'INSERT INTO {fts_table} (rowid, text) VALUES (?, ?)', [
+                (ident, text) for dtype, ident, text in docs if dtype == 'para'
+            ])
+
+        # edits made since the start are still queued
+        (self.session
+            .query(IndexQueue)
+            .filter(IndexQueue.time <= start)
+            .delete(synchronize_session=False)
+        )
+
+        # other writes went to the old tables, so redo titles that have changed since
+        # and queue paragraphs whose revision has, flushed ones are no longer queued
+        now = datetime.utcnow()
+        for aid, ts in (current := self.index_titles(now)).items():
+            if titles.get(aid) != ts:
+                self.index_title(aid, *ts, commit=False)
+        for aid in titles.keys() - current.keys():
+            self.unindex_document('title', aid, commit=False)
+        query = self.index_paras(self.session.query(Paragraph.pid, Paragraph.rid), now)
+        current = dict(query.all())
+        self.enqueue_index([
+            pid for pid in revs.keys() | current.keys() if revs.get(pid) != current.get(pid)
+        ])
+
+        self.bump_index()
+        self.session.commit()
+
+        if self.memory is not None:
+            self.load_memory_index()
+
+    # rebuild on a separate connection, so this can run off the main thread while
+    # searches are served from the old index until the new one is swapped in
+    def reindex_background(self, workers=1, progress=None):
+        def report(stage, done, total):
+            self.index_status = dict(state='warming', stage=stage, done=done, total=total)
+            if progress is not None:
+                progress(stage, done, total)
+        self.index_status = dict(state='warming')
+        other = ElltwoDB(uri=self.engine.url, index_file=self.index_file)
+        try:
+            other.reindex_articles(workers=workers, progress=report)
+            if self.memory is not None:
+                other.load_memory_index()
+                self.memory = other.memory
+        finally:
+            other.session.close()
+            other.engine.dispose()
+            self.index_status = dict(state='ready')
+
+    # sum of squared word scores by document, leaving ces to the caller
+    def score_python(self, shards, dtype=None):
         toks = set.union(*[set(s.keys()) for s in shards.values()])
 
-        # construct token query
-        query = self.session.query(TextShard)
+        # get vocabulary words sharing any token
+        query = (self.session
+            .query(IndexGram.wid, IndexGram.text, IndexGram.pos, IndexGram.count)
+            .filter(IndexGram.text.in_(toks))
+        )
+        match = defaultdict(dict)
+        for wid, tok, pos, cnt in query.all():
+            match[wid][tok] = (pos, cnt)
+
+        # score each word once against its best query word
+        score = {
+            wid: max(shard_score(s, m) for s in shards.values()) for wid, m in match.items()
+        }
+
+        # count occurrences of matched words by document
+        query = (self.session
+            .query(WordPost.source_type, WordPost.source_id, WordPost.wid, func.count())
+            .filter(WordPost.wid.in_(score))
+        )
+        if dtype is not None:
+            query = query.filter(WordPost.source_type == dtype)
+        query = query.group_by(WordPost.source_type, WordPost.source_id, WordPost.wid)
+
+        sims = defaultdict(float)
+        for t, i, wid, num in query.all():
+            sims[(t, i)] += num*score[wid]**2
+        return sims
+
+    # same as score_python with the aggregation done in the database
+    def score_sql(self, shards, dtype=None, thresh=None, limit=None):
+        # query tokens as a literal table
+        qgram = union_all(*[
+            select(
+                literal(i).label('q'), literal(t).label('text'), literal(p).label('pos'),
+                literal(c).label('count'), literal(sum(c for _, c in s.values())).label('ntoks')
+            )
+            for i, s in shards.items() for t, (p, c) in s.items()
+        ]).subquery()
+
+        # shard_score of each (query word, vocabulary word) pair
+        overlap = func.min(qgram.c.count, IndexGram.count)*func.max(
+            0.75, 1.0/(1.0 + 0.25*func.abs(qgram.c.pos - IndexGram.pos))
+        )
+        pair = (
+            select(
+                IndexGram.wid,
+                (func.sum(overlap)/func.max(qgram.c.ntoks)).label('score')
+            )
+            .join(qgram, IndexGram.text == qgram.c.text)
+            .group_by(qgram.c.q, IndexGram.wid)
+            .subquery()
+        )
+
+        # best query word for each vocabulary word
+        word = (
+            select(pair.c.wid, func.max(pair.c.score).label('score'))
+            .group_by(pair.c.wid)
+            .subquery()
+        )
+
+        # squared scores summed over occurrences
+        total = func.sum(word.c.score*word.c.score).label('total')
+        query = (
+            select(WordPost.source_type, WordPost.source_id, total)
+            .join(word, WordPost.wid == word.c.wid)
+            .group_by(WordPost.source_type, WordPost.source_id)
+        )
         if dtype is not None:
-            query = query.filter_by(source_type=dtype)
-        query = query.filter(TextShard.text.in_(toks))
+            query = query.where(WordPost.source_type == dtype)
+        if thresh is not None:
+            query = query.having(total > thresh**2)
+        if limit is not None:
+            query = query.order_by(total.desc()).limit(limit)
+
+        return {(t, i): x for t, i, x in self.session.execute(query)}
+
+    def search_engines(self):
+        if type(self.search_engine) is dict:
+            return set(self.search_engine.values())
+        return {self.search_engine}
+
+    def engine_for(self, dtype):
+        if type(self.search_engine) is dict:
+            return self.search_engine.get(dtype, 'sql')
+        return self.search_engine
+
+    def search_index(self, text, dtype=None, thresh=None, limit=None, engine=None):
+        if engine is None:
+            engine = self.engine_for(dtype)
+        if engine == 'fts':
+            return self.search_fts(text, dtype=dtype, limit=limit)
 
-        # get potential matches (move this to all-sql when finalized)
-        match = defaultdict(list)
-        for s in query.all():
-            match[(s.source_type, s.source_id, s.word_idx)].append((s.text, s.word_pos))
-        match = {i: shard_compress(sh) for i, sh in match.items()}
+        # shardify query
+        shards = {i: shard_compress(s) for i, s in shardify_document(text).items()}
 
-        # compute distance metrics
-        sims = defaultdict(list)
-        for (t, i, j), m in match.items():
-            sims[(t, i)].append(max(shard_score(s, m) for s in shards.values()))
-        sims = [(k, ces(v)) for k, v in sims.items()]
+        # ces over occurrences, with σ = 2
+        if engine == 'sql':
+            sims = self.score_sql(shards, dtype=dtype, thresh=thresh, limit=limit)
+        elif engine == 'memory':
+            self.sync_memory_index()
+            sims = self.memory.score(shards, dtype=dtype, thresh=thresh, limit=limit)
+        else:
+            sims = self.score_python(shards, dtype=dtype)
+        sims = [(k, v**(1/2)) for k, v in sims.items()]
+        if thresh is not None:
+            sims = [(k, x) for k, x in sims if x > thresh]
 
         # drop dtype if specified
         if dtype is not None:
             sims = [(i, x) for (_, i), x in sims]
 
         # return sorted highest to lowest similarity
-        return sorted(sims, key=itemgetter(1), reverse=True)
+        return sorted(sims, key=itemgetter(1), reverse=True)[:limit]
+
+    # the best k results after offset. the memory index adds documents up from their
+    # best matching words, stopping once the largest count times squared score summed
+    # over the unread words can't lift any other document past the k-th result, so the
+    # long posting lists of weak fuzzy matches are often never read. the leaders are then
+    # scored exactly from their own postings. sqlite can't stop its aggregate early, so
+    # there only the ranking is limited
+    def search_topk(self, text, k=10, offset=0, dtype=None, thresh=None, engine=None):
+        if engine is None:
+            engine = self.engine_for(dtype)
+        if engine != 'memory':
+            return self.search_index(text, dtype=dtype, thresh=thresh, limit=k+offset, engine=engine)[offset:]
+
+        # shardify query
+        shards = {i: shard_compress(s) for i, s in shardify_document(text).items()}
+        self.sync_memory_index()
+        sims = self.memory.score_topk(shards, k+offset, dtype=dtype, thresh=thresh)
+
+        sims = [(key, v**(1/2)) for key, v in sims.items()]
+        if thresh is not None:
+            sims = [(key, x) for key, x in sims if x > thresh]
+        if dtype is not None:
+            sims = [(i, x) for (_, i), x in sims]
+        return sorted(sims, key=itemgetter(1), reverse=True)[offset:offset+k]
+
+    # paragraphs ranked by bm25, which has its own scale so thresh does not apply
+    def search_fts(self, text, dtype=None, limit=None):
+        if dtype not in (None, 'para') or len(match := fts_query(text)) == 0:
+            return []
+        sql = f'SELECT rowid, -bm25({fts_table}) FROM {fts_table} WHERE {fts_table} MATCH ? ORDER BY rank'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        sims = self.session.connection().exec_driver_sql(sql, (match,)).all()
+        if dtype is None:
+            return [(('para', i), x) for i, x in sims]
+        return [(i, x) for i, x in sims]
+
+    # matching passages of paragraphs, with the terms wrapped for highlighting
+    def search_snippets(self, text, pids, size=24):
+        if not self.fts or len(pids) == 0 or len(match := fts_query(text)) == 0:
+            return {}
+        marks = ', '.join('?'*len(pids))
+        sql = (
+            f'SELECT rowid, snippet({fts_table}, 0, ?, ?, ?, {int(size)}) FROM {fts_table} '
+            f'WHERE {fts_table} MATCH ? AND rowid IN ({marks})'
+        )
+        args = ('<span class="hl">', '</span>', '…', match, *pids)
+        return dict(self.session.connection().exec_driver_sql(sql, args).all())
@@ -1,8 +1,12 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, LargeBinary
+from sqlalchemy import (
+    Column, Integer, Float, String, Text, DateTime, ForeignKey, Boolean, LargeBinary, Index, DDL, event
+)
 from sqlalchemy.ext.declarative import declarative_base
 from flask_login import UserMixin
 
+from .tools import text_hash
+
 Base = declarative_base()
 
 class Article(Base):
@@ -17,6 +21,10 @@ class Article(Base):
     create_time = Column(DateTime, default=datetime.utcnow)
     delete_time = Column(DateTime)
 
+    __table_args__ = (
+        Index('ix_article_short_time', 'short_title', 'delete_time', 'create_time'),
+    )
+
     def __repr__(self):
         return f'{self.aid} [{self.create_time} → {self.delete_time}]: {self.title} ({self.short_title})'
 
@@ -26,10 +34,23 @@ class Paragraph(Base):
     rid = Column(Integer, primary_key=True)
     pid = Column(Integer)
     aid = Column(Integer, ForeignKey('article.aid'))
-    text = Column(Text, nullable=False)
+    text = Column(Text, nullable=False) # empty if stored in blob
+    hash = Column(String(40), default=lambda ctx: text_hash(ctx.get_current_parameters()['text']))
+    base = Column(Integer) # if set, text is a delta against this later revision
+    depth = Column(Integer) # deltas chained onto this revision
     create_time = Column(DateTime, default=datetime.utcnow)
     delete_time = Column(DateTime)
 
+    __table_args__ = (
+        Index('ix_paragraph_aid_time', 'aid', 'delete_time', 'create_time'),
+        Index('ix_paragraph_pid_time', 'pid', 'delete_time', 'create_time'),
+        Index('ix_paragraph_aid_now', 'aid', 'pid', sqlite_where=delete_time.is_(None)),
+        Index('ix_paragraph_pid_now', 'pid', sqlite_where=delete_time.is_(None)),
+        Index('ix_paragraph_aid_create', 'aid', 'create_time'),
+        Index('ix_paragraph_base', 'base', sqlite_where=base.isnot(None)),
+        Index('ix_paragraph_blob', 'hash', sqlite_where=text == ''),
+    )
+
     def __repr__(self):
         return f'{self.aid}/{self.pid} [{self.create_time} → {self.delete_time}]:\n{self.text}'
 
@@ -41,12 +62,125 @@ class Paralink(Base):
     pid = Column(Integer, ForeignKey('paragraph.pid'))
     prev = Column(Integer, ForeignKey('paragraph.pid'))
     next = Column(Integer, ForeignKey('paragraph.pid'))
+    rank = Column(Integer) # sort key of current links, not versioned
     create_time = Column(DateTime, default=datetime.utcnow)
     delete_time = Column(DateTime)
 
+    __table_args__ = (
+        Index('ix_paralink_aid_time', 'aid', 'delete_time', 'create_time'),
+        Index('ix_paralink_pid_time', 'pid', 'delete_time', 'create_time'),
+        Index('ix_paralink_aid_now', 'aid', 'pid', sqlite_where=delete_time.is_(None)),
+        Index('ix_paralink_pid_now', 'pid', sqlite_where=delete_time.is_(None)),
+        Index('ix_paralink_aid_create', 'aid', 'create_time'),
+    )
+
     def __repr__(self):
         return f'{self.aid}/{self.lid} [{self.create_time} → {self.delete_time}]: {self.prev}—{self.pid}—{self.next}'
 
+# live rows only, kept in sync with the revision tables by triggers
+
+def head_sync(base, head, key, cols):
+    names = ', '.join(cols)
+    fresh = ', '.join(f'NEW.{c}' for c in cols)
+    return [
+        f'DROP TRIGGER IF EXISTS {head}_insert',
+        f'DROP TRIGGER IF EXISTS {head}_update',
+        f'DROP TRIGGER IF EXISTS {head}_delete',
+        f'''CREATE TRIGGER IF NOT EXISTS {head}_insert AFTER INSERT ON {base}
+        WHEN NEW.delete_time IS NULL BEGIN
+            INSERT OR REPLACE INTO {head} ({names}) VALUES ({fresh});
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {head}_update AFTER UPDATE ON {base} BEGIN
+            DELETE FROM {head} WHERE {key} = OLD.{key};
+            INSERT OR REPLACE INTO {head} ({names}) SELECT {fresh} WHERE NEW.delete_time IS NULL;
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {head}_delete AFTER DELETE ON {base} BEGIN
+            DELETE FROM {head} WHERE {key} = OLD.{key};
+        END''',
+        f'''INSERT OR REPLACE INTO {head} ({names})
+        SELECT {names} FROM {base} WHERE delete_time IS NULL ORDER BY create_time''',
+    ]
+
+class ParagraphHead(Base):
+    __tablename__ = 'paragraph_head'
+
+    pid = Column(Integer, primary_key=True)
+    rid = Column(Integer, ForeignKey('paragraph.rid'), nullable=False)
+    aid = Column(Integer, ForeignKey('article.aid'), nullable=False)
+
+    __table_args__ = (
+        Index('ix_paragraph_head_rid', 'rid', unique=True),
+        Index('ix_paragraph_head_aid', 'aid'),
+        {'info': {'derived': True}},
+    )
+
+    def __repr__(self):
+        return f'{self.aid}/{self.pid}: {self.rid}'
+
+class ParalinkHead(Base):
+    __tablename__ = 'paralink_head'
+
+    pid = Column(Integer, primary_key=True)
+    lid = Column(Integer, ForeignKey('paralink.lid'), nullable=False)
+    aid = Column(Integer, ForeignKey('article.aid'), nullable=False)
+    rank = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_paralink_head_lid', 'lid', unique=True),
+        Index('ix_paralink_head_rank', 'aid', 'rank'),
+        {'info': {'derived': True}},
+    )
+
+    def __repr__(self):
+        return f'{self.aid}/{self.pid}: {self.lid} ({self.rank})'
+
+for sql in head_sync('paragraph', 'paragraph_head', 'rid', ['pid', 'rid', 'aid']):
+    event.listen(ParagraphHead.__table__, 'after_create', DDL(sql))
+for sql in head_sync('paralink', 'paralink_head', 'lid', ['pid', 'lid', 'aid', 'rank']):
+    event.listen(ParalinkHead.__table__, 'after_create', DDL(sql))
+
+class Blob(Base):
+    __tablename__ = 'blob'
+
+    hash = Column(String(40), primary_key=True)
+    text = Column(Text, nullable=False)
+
+    def __repr__(self):
+        return f'{self.hash}: {self.text}'
+
+class Journal(Base):
+    __tablename__ = 'journal'
+
+    jid = Column(Integer, primary_key=True)
+    aid = Column(Integer, ForeignKey('article.aid'), nullable=False)
+    time = Column(DateTime, nullable=False)
+    kind = Column(String(10), nullable=False)
+    pids = Column(Text) # space separated
+
+    __table_args__ = (
+        Index('ix_journal_aid_time', 'aid', 'time'),
+    )
+
+    def __repr__(self):
+        return f'{self.aid} [{self.time}] {self.kind}: {self.pids}'
+
+class Checkpoint(Base):
+    __tablename__ = 'checkpoint'
+
+    cid = Column(Integer, primary_key=True)
+    aid = Column(Integer, ForeignKey('article.aid'), nullable=False)
+    time = Column(DateTime, nullable=False)
+    pids = Column(Text) # json lists in article order
+    rids = Column(Text)
+    lids = Column(Text)
+
+    __table_args__ = (
+        Index('ix_checkpoint_aid_time', 'aid', 'time'),
+    )
+
+    def __repr__(self):
+        return f'{self.aid} [{self.time}]: {self.pids}'
+
 class Bib(Base):
     __tablename__ = 'bib'
 
@@ -67,6 +201,11 @@ class Bib(Base):
     create_time = Column(DateTime, default=datetime.utcnow)
     delete_time = Column(DateTime)
 
+    __table_args__ = (
+        Index('ix_bib_citekey_time', 'citekey', 'delete_time', 'create_time'),
+        Index('ix_bib_now', 'citekey', sqlite_where=delete_time.is_(None)),
+    )
+
     def __repr__(self):
         return f'{self.bid} [{self.create_time} → {self.delete_time}]: {self.author} ({self.year})'
 
@@ -83,6 +222,11 @@ class ExtRef(Base):
     create_time = Column(DateTime, default=datetime.utcnow)
     delete_time = Column(DateTime)
 
+    __table_args__ = (
+        Index('ix_ext_ref_aid_time', 'aid', 'key', 'delete_time', 'create_time'),
+        Index('ix_ext_ref_now', 'aid', 'key', sqlite_where=delete_time.is_(None)),
+    )
+
     def __repr__(self):
         return f'{self.key} [{self.create_time} → {self.delete_time}]:\n{self.text}'
 
@@ -95,6 +239,12 @@ class Tag(Base):
     create_time = Column(DateTime, default=datetime.utcnow)
     delete_time = Column(DateTime)
 
+    __table_args__ = (
+        Index('ix_tag_aid_time', 'aid', 'delete_time', 'create_time'),
+        Index('ix_tag_tag_time', 'tag', 'delete_time', 'create_time'),
+        Index('ix_tag_now', 'tag', 'aid', sqlite_where=delete_time.is_(None)),
+    )
+
     def __repr__(self):
         return f'{self.tag} [{self.create_time} → {self.delete_time}]'
 
@@ -109,6 +259,11 @@ class Image(Base):
     create_time = Column(DateTime, default=datetime.utcnow)
     delete_time = Column(DateTime)
 
+    __table_args__ = (
+        Index('ix_image_key_time', 'key', 'delete_time', 'create_time'),
+        Index('ix_image_now', 'key', sqlite_where=delete_time.is_(None)),
+    )
+
     def __repr__(self):
         return f'{self.key} ({self.mime}) [{self.create_time} → {self.delete_time}]'
 
@@ -128,15 +283,75 @@ class User(UserMixin, Base):
         conf = 'confirmed' if self.confirmed else 'unconfirmed'
         return f'{self.email} [{conf}]: {self.name}'
 
-class TextShard(Base):
-    __tablename__ = 'textshard'
+# distinct indexed words
+class IndexWord(Base):
+    __tablename__ = 'index_word'
+
+    wid = Column(Integer, primary_key=True)
+    word = Column(Text, nullable=False)
+
+    __table_args__ = (
+        Index('ix_index_word_word', 'word', unique=True),
+    )
+
+    def __repr__(self):
+        return f'{self.wid}: {self.word}'
+
+# trigrams of each word, compressed to mean position and count
+class IndexGram(Base):
+    __tablename__ = 'index_gram'
 
     id = Column(Integer, primary_key=True)
+    wid = Column(Integer, ForeignKey('index_word.wid'), nullable=False)
     text = Column(String(10), nullable=False)
+    pos = Column(Float, nullable=False)
+    count = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index('ix_index_gram_text', 'text', 'wid', 'pos', 'count'),
+    )
+
+    def __repr__(self):
+        return f'{self.wid}/{self.pos}: {self.text} ×{self.count}'
+
+# occurrences of each word in documents
+class WordPost(Base):
+    __tablename__ = 'word_post'
+
+    id = Column(Integer, primary_key=True)
+    wid = Column(Integer, ForeignKey('index_word.wid'), nullable=False)
     word_idx = Column(Integer, nullable=False)
-    word_pos = Column(Integer, nullable=False)
     source_type = Column(String(10), nullable=False)
     source_id = Column(Integer, nullable=False)
 
+    __table_args__ = (
+        Index('ix_word_post_wid', 'wid', 'source_type', 'source_id'),
+        Index('ix_word_post_source', 'source_id', 'source_type'), # not by type alone
+    )
+
+    def __repr__(self):
+        return f'{self.source_type}/{self.source_id}/{self.word_idx}: {self.wid}'
+
+# paragraphs edited since they were last indexed
+class IndexQueue(Base):
+    __tablename__ = 'index_queue'
+
+    pid = Column(Integer, primary_key=True)
+    time = Column(DateTime, nullable=False) # last edit
+
+    __table_args__ = (
+        Index('ix_index_queue_time', 'time'),
+    )
+
+    def __repr__(self):
+        return f'{self.pid} [{self.time}]'
+
+# database wide counters
+class Meta(Base):
+    __tablename__ = 'meta'
+
+    key = Column(String(50), primary_key=True)
+    value = Column(Integer, nullable=False)
+
     def __repr__(self):
-        return f'{self.source_id}/{self.pos}: {self.text}'
+        return f'{self.key}: {self.value}'
@@ -0,0 +1,463 @@
+##
+## in-memory trigram search (requires numpy)
+##
+
+import os, json, mmap
+from threading import Lock
+from collections import defaultdict
+
+import numpy as np
+
+from .query import shardify, shard_compress
+
+# on-disk format, bump the version when the layout changes
+index_magic = b'L2IX'
+index_version = 1
+index_align = 64
+
+# growable 1d array, possibly starting from a read-only one
+class Column:
+    def __init__(self, dtype, data=None):
+        self.data = np.zeros(1024, dtype=dtype) if data is None else data
+        self.size = 0 if data is None else len(data)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, val):
+        if self.size == len(self.data):
+            grow = np.zeros(max(1024, len(self.data)), dtype=self.data.dtype)
+            self.data = np.concatenate([self.data, grow])
+        self.data[self.size] = val
+        self.size += 1
+
+    def view(self):
+        return self.data[:self.size]
+
+# pack (key, ...) lists into csr form sorted by key
+def pack_csr(nkeys, keys, *vals):
+    order = np.argsort(keys, kind='stable')
+    ptr = np.zeros(nkeys+1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=nkeys), out=ptr[1:])
+    return (ptr, *[v[order] for v in vals])
+
+# indices covering [ptr[k], ptr[k+1]) for each k in keys
+def csr_gather(ptr, keys):
+    starts, lens = ptr[keys], ptr[keys+1] - ptr[keys]
+    offset = np.repeat(starts - np.cumsum(lens) + lens, lens)
+    return offset + np.arange(lens.sum()), lens
+
+# strings as one utf-8 buffer with offsets
+def pack_strings(strs):
+    data = [s.encode('utf-8') for s in strs]
+    ptr = np.zeros(len(data)+1, dtype=np.int64)
+    np.cumsum([len(d) for d in data], out=ptr[1:])
+    return np.frombuffer(b''.join(data), dtype=np.uint8), ptr
+
+def unpack_strings(buf, ptr):
+    raw = buf.tobytes()
+    return [raw[a:b].decode('utf-8') for a, b in zip(ptr[:-1].tolist(), ptr[1:].tolist())]
+
+def align(n):
+    return -(-n // index_align) * index_align
+
+class MemoryIndex:
+    # arrays making up a packed index, in file order
+    packed = [
+        'gram_key', 'gram_ptr', 'gram_wix', 'gram_pos', 'gram_cnt', 'word_buf', 'word_ptr',
+        'post_ptr', 'post_dix', 'post_cnt', 'doc_type', 'doc_id',
+    ]
+
+    def __init__(self, pending=4096):
+        self.pending = pending
+        self.lock = Lock()
+
+        # index generation this reflects and the one last written out
+        self.generation = None
+        self.saved = None
+
+        self.clear()
+
+    def clear(self, dtype=None):
+        with self.lock:
+            if dtype is not None:
+                if dtype in self.types:
+                    code = self.types.index(dtype)
+                    self.alive.view()[self.doc_type.view() == code] = False
+                    self.docs = None
+                return
+
+            self.set_packed([], {
+                'gram_key': np.zeros(0, dtype='U3'),
+                'gram_ptr': np.zeros(1, dtype=np.int64),
+                'gram_wix': np.zeros(0, dtype=np.int32),
+                'gram_pos': np.zeros(0, dtype=np.float64),
+                'gram_cnt': np.zeros(0, dtype=np.int32),
+                'word_buf': np.zeros(0, dtype=np.uint8),
+                'word_ptr': np.zeros(1, dtype=np.int64),
+                'post_ptr': np.zeros(1, dtype=np.int64),
+                'post_dix': np.zeros(0, dtype=np.int32),
+                'post_cnt': np.zeros(0, dtype=np.int32),
+                'doc_type': np.zeros(0, dtype=np.int8),
+                'doc_id': np.zeros(0, dtype=np.int64),
+            })
+
+    # grams by sorted trigram, words by index, word postings by word, and documents,
+    # anything added later is held pending until the next pack
+    def set_packed(self, types, arrays):
+        self.types = list(types)
+        for name in self.packed:
+            setattr(self, name, arrays[name])
+        self.doc_type = Column(np.int8, data=self.doc_type)
+        self.doc_id = Column(np.int64, data=self.doc_id)
+        self.alive = Column(np.bool_, data=np.ones(len(self.doc_id), dtype=np.bool_))
+
+        self.gram_new = defaultdict(list)
+        self.gram_num = 0
+        self.word_new = []
+        self.post_new = []
+
+        # lookups are only needed for updates, so built on demand
+        self.words = None
+        self.docs = None
+        self.forward = None
+
+    def __len__(self):
+        return int(self.alive.view().sum())
+
+    ##
+    ## updates
+    ##
+
+    def word_lookup(self):
+        if self.words is None:
+            words = unpack_strings(self.word_buf, self.word_ptr) + self.word_new
+            self.words = {w: i for i, w in enumerate(words)}
+        return self.words
+
+    def doc_lookup(self):
+        if self.docs is None:
+            live = np.flatnonzero(self.alive.view())
+            types = self.doc_type.view()[live].tolist()
+            idents = self.doc_id.view()[live].tolist()
+            self.docs = {
+                (self.types[t], i): d for d, t, i in zip(live.tolist(), types, idents)
+            }
+        return self.docs
+
+    def word_index(self, word):
+        words = self.word_lookup()
+        if (wix := words.get(word)) is None:
+            words[word] = wix = len(words)
+            self.word_new.append(word)
+            for tok, (pos, cnt) in shard_compress(shardify(f' {word} ')).items():
+                self.gram_new[tok].append((wix, pos, cnt))
+                self.gram_num += 1
+        return wix
+
+    def type_code(self, dtype):
+        if dtype not in self.types:
+            self.types.append(dtype)
+        return self.types.index(dtype)
+
+    # counts is {word: occurrences}
+    def add(self, dtype, ident, counts):
+        with self.lock:
+            self.insert(dtype, ident, counts)
+            if len(self.post_new) > self.pending or self.gram_num > self.pending:
+                self.pack()
+
+    # docs is {(dtype, ident): counts}, packed once at the end
+    def load(self, docs):
+        with self.lock:
+            for (dtype, ident), counts in docs.items():
+                self.insert(dtype, ident, counts)
+            self.pack()
+
+    def insert(self, dtype, ident, counts):
+        self.drop((dtype, ident))
+        dix = len(self.alive)
+        self.doc_lookup()[(dtype, ident)] = dix
+        self.doc_type.append(self.type_code(dtype))
+        self.doc_id.append(ident)
+        self.alive.append(True)
+        for word, num in counts.items():
+            self.post_new.append((self.word_index(word), dix, num))
+
+    def remove(self, dtype, ident):
+        with self.lock:
+            self.drop((dtype, ident))
+
+    def drop(self, key):
+        if (dix := self.doc_lookup().pop(key, None)) is not None:
+            self.alive.data[dix] = False
+
+    # fold pending entries into the packed arrays and forget removed documents
+    def pack(self):
+        # grams never go away, so merge and resort by trigram
+        if self.gram_num > 0:
+            new = [(tok, *ent) for tok, ents in self.gram_new.items() for ent in ents]
+            toks = np.concatenate([
+                np.repeat(self.gram_key, np.diff(self.gram_ptr)),
+                np.array([t for t, *_ in new], dtype='U3'),
+            ])
+            keys, gix = np.unique(toks, return_inverse=True)
+            wix = np.concatenate([self.gram_wix, [w for _, w, _, _ in new]]).astype(np.int32)
+            pos = np.concatenate([self.gram_pos, [p for _, _, p, _ in new]]).astype(np.float64)
+            cnt = np.concatenate([self.gram_cnt, [c for _, _, _, c in new]]).astype(np.int32)
+            self.gram_ptr, self.gram_wix, self.gram_pos, self.gram_cnt = pack_csr(
+                len(keys), gix.ravel(), wix, pos, cnt
+            )
+            self.gram_key = keys
+            self.gram_new.clear()
+            self.gram_num = 0
+
+        # words are only ever appended
+        if len(self.word_new) > 0:
+            buf, ptr = pack_strings(self.word_new)
+            self.word_buf = np.concatenate([self.word_buf, buf])
+            self.word_ptr = np.concatenate([self.word_ptr, ptr[1:] + self.word_ptr[-1]])
+            self.word_new = []
+
+        # renumber live documents densely
+        live = np.flatnonzero(self.alive.view())
+        remap = np.full(len(self.alive)+1, -1, dtype=np.int64)
+        remap[live] = np.arange(len(live))
+
+        wix = np.repeat(np.arange(len(self.post_ptr)-1), np.diff(self.post_ptr))
+        dix, cnt = self.post_dix, self.post_cnt
+        if len(self.post_new) > 0:
+            w1, d1, c1 = map(np.array, zip(*self.post_new))
+            wix, dix, cnt = np.concatenate([wix, w1]), np.concatenate([dix, d1]), np.concatenate([cnt, c1])
+        keep = remap[dix] >= 0
+        wix, dix, cnt = wix[keep].astype(np.int64), remap[dix[keep]].astype(np.int32), cnt[keep].astype(np.int32)
+        self.post_ptr, self.post_dix, self.post_cnt = pack_csr(len(self.word_ptr)-1, wix, dix, cnt)
+        self.post_new = []
+
+        self.doc_type = Column(np.int8, data=self.doc_type.view()[live])
+        self.doc_id = Column(np.int64, data=self.doc_id.view()[live])
+        self.alive = Column(np.bool_, data=np.ones(len(live), dtype=np.bool_))
+        self.docs = None
+        self.forward = None
+
+    ##
+    ## storage
+    ##
+
+    # a json header followed by aligned arrays that can be mapped straight from the file,
+    # written aside and moved into place so readers never see a partial file
+    def save(self, path):
+        with self.lock:
+            if self.saved is not None and self.saved == self.generation:
+                return False
+            self.pack()
+
+            arrays = {name: getattr(self, name) for name in self.packed}
+            arrays['doc_type'], arrays['doc_id'] = self.doc_type.view(), self.doc_id.view()
+            layout, offset = {}, 0
+            for name, arr in arrays.items():
+                layout[name] = dict(dtype=arr.dtype.str, count=len(arr), offset=offset)
+                offset += align(arr.nbytes)
+            head = json.dumps(dict(
+                version=index_version, generation=self.generation, types=self.types,
+                arrays=layout
+            )).encode('utf-8')
+            base = align(len(index_magic) + 8 + len(head))
+
+            temp = f'{path}.tmp'
+            with open(temp, 'wb') as fid:
+                fid.write(index_magic + len(head).to_bytes(8, 'little') + head)
+                for name, arr in arrays.items():
+                    fid.seek(base + layout[name]['offset'])
+                    fid.write(np.ascontiguousarray(arr).tobytes())
+                fid.truncate(base + offset)
+            os.replace(temp, path)
+
+            self.saved = self.generation
+            return True
+
+    # map a saved index, its pages are shared by every process reading the file
+    @classmethod
+    def open(cls, path, pending=4096):
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as fid:
+            if fid.read(len(index_magic)) != index_magic:
+                return
+            size = int.from_bytes(fid.read(8), 'little')
+            head = json.loads(fid.read(size))
+            if head['version'] != index_version:
+                return
+            data = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        base = align(len(index_magic) + 8 + size)
+
+        index = cls(pending=pending)
+        index.set_packed(head['types'], {
+            name: np.frombuffer(
+                data, dtype=info['dtype'], count=info['count'], offset=base+info['offset']
+            ) for name, info in head['arrays'].items()
+        })
+        index.generation = index.saved = head['generation']
+        return index
+
+    ##
+    ## scoring
+    ##
+
+    # sums of squared word scores by document, as in ElltwoDB.score_python
+    def score(self, shards, dtype=None, thresh=None, limit=None):
+        with self.lock:
+            if dtype is not None and dtype not in self.types:
+                return {}
+
+            cand, wscore = self.match_words(shards)
+            if len(cand) == 0:
+                return {}
+
+            # squared scores summed over occurrences
+            npack = len(self.post_ptr) - 1
+            idx, lens = csr_gather(self.post_ptr, cand[cand < npack])
+            dix = self.post_dix[idx]
+            wgt = self.post_cnt[idx]*np.repeat(wscore[cand < npack]**2, lens)
+            total = np.bincount(dix, weights=wgt, minlength=len(self.alive)).astype(np.float64)
+            if len(self.post_new) > 0:
+                best = dict(zip(cand.tolist(), wscore.tolist()))
+                for w, d, n in self.post_new:
+                    if (s := best.get(w)) is not None:
+                        total[d] += n*s**2
+
+            # filter by liveness, type and threshold
+            mask = self.alive.view() & (total > 0)
+            if dtype is not None:
+                mask &= self.doc_type.view() == self.types.index(dtype)
+            if thresh is not None:
+                mask &= total > thresh**2
+            found = np.flatnonzero(mask)
+            if limit is not None and len(found) > limit:
+                found = found[np.argsort(-total[found], kind='stable')[:limit]]
+
+            types = self.doc_type.view()[found].tolist()
+            idents = self.doc_id.view()[found].tolist()
+            return {
+                (self.types[t], i): x for t, i, x in zip(types, idents, total[found].tolist())
+            }
+
+    # packed postings by document, and the largest count of each word, built on demand
+    def doc_postings(self):
+        if self.forward is None:
+            nword, ndoc = len(self.post_ptr) - 1, int(self.post_dix.max(initial=-1)) + 1
+            wix = np.repeat(np.arange(nword), np.diff(self.post_ptr))
+            doc_ptr, doc_wix, doc_cnt = pack_csr(ndoc, self.post_dix, wix, self.post_cnt)
+            word_max = np.zeros(nword, dtype=np.int64)
+            np.maximum.at(word_max, wix, self.post_cnt)
+            self.forward = doc_ptr, doc_wix, doc_cnt, word_max
+        return self.forward
+
+    # as score, but for the best need documents only, as in ElltwoDB.search_topk
+    def score_topk(self, shards, need, dtype=None, thresh=None, batch=256):
+        with self.lock:
+            if need <= 0 or (dtype is not None and dtype not in self.types):
+                return {}
+
+            # strongest words first
+            cand, wscore = self.match_words(shards)
+            order = np.argsort(-wscore, kind='stable')
+            cand, wscore = cand[order], wscore[order]
+
+            # pending words are few, so take them all up front
+            total = np.zeros(len(self.alive))
+            if len(self.post_new) > 0:
+                best = dict(zip(cand.tolist(), wscore.tolist()))
+                for w, d, n in self.post_new:
+                    if (s := best.get(w)) is not None:
+                        total[d] += n*s**2
+
+            mask = self.alive.view().copy()
+            if dtype is not None:
+                mask &= self.doc_type.view() == self.types.index(dtype)
+
+            # the most any document can still gain from the packed words from i on
+            doc_ptr, doc_wix, doc_cnt, word_max = self.doc_postings()
+            npack = len(self.post_ptr) - 1
+            packed = cand < npack
+            gain = np.zeros(len(cand))
+            gain[packed] = word_max[cand[packed]]*wscore[packed]**2
+            rest = np.append(np.cumsum(gain[::-1])[::-1], 0)
+
+            # add postings in growing batches until nothing outside the leading need
+            # documents can overtake them or pass thresh
+            floor = thresh**2 if thresh is not None else -np.inf
+            done = 0
+            while done < len(cand):
+                live = total[mask]
+                if len(live) <= need:
+                    break
+                part = np.partition(live, [len(live)-need-1, len(live)-need])
+                outside, inside = part[len(live)-need-1], part[len(live)-need]
+                if outside + rest[done] <= max(inside, floor):
+                    break
+                wix, ws = cand[done:done+batch], wscore[done:done+batch]
+                packed = wix < npack
+                idx, lens = csr_gather(self.post_ptr, wix[packed])
+                wgt = self.post_cnt[idx]*np.repeat(ws[packed]**2, lens)
+                total += np.bincount(self.post_dix[idx], weights=wgt, minlength=len(total))
+                done += batch
+                batch *= 2
+
+            # keep the leading documents, settling unread words through their postings.
+            # documents added since the last pack have only pending postings, all counted
+            top = np.flatnonzero(mask)
+            if len(top) > need:
+                top = top[np.argpartition(-total[top], need)[:need]]
+            if done < len(cand):
+                score = np.zeros(npack + len(self.word_new))
+                score[cand] = wscore
+                old = top[top < len(doc_ptr) - 1]
+                idx, lens = csr_gather(doc_ptr, old)
+                wgt = doc_cnt[idx]*score[doc_wix[idx]]**2
+                total[old] = np.bincount(np.repeat(np.arange(len(old)), lens), weights=wgt, minlength=len(old))
+
+            top = top[total[top] > 0]
+            if thresh is not None:
+                top = top[total[top] > thresh**2]
+            types = self.doc_type.view()[top].tolist()
+            idents = self.doc_id.view()[top].tolist()
+            return {
+                (self.types[t], i): x for t, i, x in zip(types, idents, total[top].tolist())
+            }
+
+    # best shard_score of each vocabulary word sharing a gram with the query words
+    def match_words(self, shards):
+        # (query word, vocabulary word, contribution) for every shared gram
+        qs, ws, cs = [], [], []
+        for q, shard in shards.items():
+            ntoks = sum(c for _, c in shard.values())
+            for tok, (p1, c1) in shard.items():
+                wix, pos, cnt = self.gram_entries(tok)
+                if len(wix) == 0:
+                    continue
+                dist = np.maximum(0.75, 1/(1+0.25*np.abs(p1-pos)))
+                qs.append(np.full(len(wix), q))
+                ws.append(wix)
+                cs.append(np.minimum(c1, cnt)*dist/ntoks)
+        if len(ws) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        qs, ws, cs = np.concatenate(qs), np.concatenate(ws), np.concatenate(cs)
+
+        # best query word for each vocabulary word
+        cand, inv = np.unique(ws, return_inverse=True)
+        pair = np.zeros((len(cand), max(shards)+1))
+        np.add.at(pair, (inv.ravel(), qs), cs)
+        return cand, pair.max(axis=1)
+
+    def gram_entries(self, tok):
+        gix = np.searchsorted(self.gram_key, tok)
+        if gix < len(self.gram_key) and self.gram_key[gix] == tok:
+            lo, hi = self.gram_ptr[gix], self.gram_ptr[gix+1]
+            wix, pos, cnt = self.gram_wix[lo:hi], self.gram_pos[lo:hi], self.gram_cnt[lo:hi]
+        else:
+            wix, pos, cnt = [np.zeros(0)]*3
+        if len(new := self.gram_new.get(tok, [])) > 0:
+            w1, p1, c1 = map(np.array, zip(*new))
+            wix, pos, cnt = np.concatenate([wix, w1]), np.concatenate([pos, p1]), np.concatenate([cnt, c1])
+        return wix.astype(np.int64), pos.astype(np.float64), cnt.astype(np.float64)
@@ -1,6 +1,11 @@
 import os
-from collections import defaultdict
+import json
+import hashlib
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher
 from secrets import token_hex
+from threading import Lock
 
 class Multimap:
     def __init__(self, init=None):
@@ -42,6 +47,78 @@ class Multimap:
     def loc(self, item):
         return self._locs.get(item, None)
 
+class LRUCache:
+    def __init__(self, size=128):
+        self.size = size
+        self._data = OrderedDict()
+
+    def __repr__(self):
+        return f'LRUCache({len(self._data)}/{self.size})'
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def set(self, key, val):
+        self._data[key] = val
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+class IdAllocator:
+    def __init__(self, start=0):
+        self.next = start
+        self._lock = Lock()
+
+    def __repr__(self):
+        return f'IdAllocator({self.next})'
+
+    def take(self, n=1):
+        with self._lock:
+            start = self.next
+            self.next += n
+        return start
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+# text as a json list of [i, j] spans copied from base and literal strings
+def text_delta(base, text):
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, base, text).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(text[j1:j2])
+    return json.dumps(ops, separators=(',', ':'))
+
+def apply_delta(base, delta):
+    return ''.join([
+        base[op[0]:op[1]] if type(op) is list else op for op in json.loads(delta)
+    ])
+
+# map over a process pool when there is more than one worker and batch
+def pool_map(func, args, workers=1):
+    if workers > 1 and len(args) > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            yield from pool.map(func, args)
+    else:
+        yield from map(func, args)
+
 def gen_auth():
     return {
         'SECRET_KEY': token_hex(16),
@@ -2,6 +2,7 @@
 
 import os, argparse, toml, secrets, webbrowser
 from io import BytesIO
+from datetime import datetime, timedelta
 from pathlib import Path
 from collections import namedtuple
 from threading import Timer
@@ -24,7 +25,7 @@ from flask_cors import CORS, cross_origin
 
 # import db tools
 from elltwo.tools import Multimap, gen_auth, secret_dict
-from elltwo.query import ElltwoDB, order_links, urlify
+from elltwo.query import ElltwoDB, urlify
 
 # necessary hack
 from engineio.payload import Payload
@@ -41,7 +42,9 @@ parser.add_argument('--port', type=int, default=5000, help='Main port to serve o
 parser.add_argument('--debug', action='store_true', help='Run in debug mode')
 parser.add_argument('--login', action='store_true', help='Require login for editing')
 parser.add_argument('--private', action='store_true', help='Require login for viewing/editing')
-parser.add_argument('--reindex', action='store_true', help='Reindex search database on load')
+parser.add_argument('--reindex', action='store_true', help='Reindex search database in the background on load')
+parser.add_argument('--memory-index', action='store_true', help='Serve searches from memory, mapped from db.idx (requires numpy)')
+parser.add_argument('--fts', action='store_true', help='Serve full text searches from an sqlite fts5 table')
 parser.add_argument('--demo', action='store_true', help='Go to index by default')
 parser.add_argument('--no-browser', action='store_true', help='Do not launch browser on startup')
 parser.add_argument('--conf', type=str, default=None, help='Path to configuation file')
@@ -74,6 +77,15 @@ config = {
     'demo_path': 'default/demo.md', # path to demo content
     'themes': themes, # all themes by default
     'macros': {}, # no latex macros by default
+    'compact_days': None, # compact history older than this many days, off by default
+    'compact_granularity': 'hour', # keep one revision per bucket when compacting
+    'compact_interval': 24*60*60, # seconds between compaction runs
+    'delta_keyframe': None, # store old revisions as deltas with this keyframe spacing, off by default
+    'dedup_text': False, # store old revision texts once by hash
+    'index_delay': 2, # seconds without edits before a paragraph is reindexed
+    'index_interval': 1, # seconds between index queue flushes
+    'index_batch': 1000, # most paragraphs to reindex per flush
+    'index_save_interval': 5*60, # seconds between writes of the memory index file
 }
 
 #config to pass to templets
@@ -126,8 +138,15 @@ if args.mail is not None:
 else:
     mail = None
 
-# load sqlalchemy
-edb = ElltwoDB(path=args.db, reindex=args.reindex)
+# load sqlalchemy, titles stay fuzzy with fts
+search_engine = 'memory' if args.memory_index else 'sql'
+if args.fts:
+    search_engine = dict(title=search_engine, para='fts')
+edb = ElltwoDB(
+    path=args.db, keyframe=config['delta_keyframe'],
+    dedup=config['dedup_text'], search_engine=search_engine,
+    index_file=f'{args.db}.idx' if args.memory_index else None
+)
 
 # create socketio
 socketio = SocketIO(app)
@@ -594,6 +613,20 @@ def update_para(data):
     else:
         return False
 
+@socketio.on('update_paras')
+@edit_decor
+def update_paras(data):
+    sid = request.sid
+    aid, paras = data['aid'], data['paras']
+    paras = {int(pid): text for pid, text in paras.items()}
+    if any(locked.loc(str(pid)) not in (None, sid) for pid in paras):
+        return False
+    pids = edb.bulk_update(paras)
+    upds = {pid: paras[pid] for pid in pids}
+    emit('updateBulk', upds, room=str(aid), include_self=False)
+    trueUnlock(aid, pids, sid)
+    return True
+
 @socketio.on('insert_para')
 @edit_decor
 def insert_para(data):
@@ -622,8 +655,13 @@ def paste_paras(data):
 @socketio.on('delete_paras')
 @edit_decor
 def delete_paras(data):
-    aid, pids = data['aid'], data['pids']
-    edb.delete_paras(pids)
+    aid = data['aid']
+    if 'pids' in data:
+        pids = edb.delete_paras(data['pids'])
+    else:
+        pids = edb.delete_range(aid, data['first_pid'], data['last_pid'])
+    if pids is None:
+        return False
     emit('deleteParas', pids, room=str(aid), include_self=False)
     return True
 
@@ -631,7 +669,8 @@ def delete_paras(data):
 @view_decor
 def get_commits(data):
     aid = data['aid']
-    dates = edb.get_commits(aid=aid)
+    offset, limit = data.get('offset', 0), data.get('limit')
+    dates = edb.get_commits(aid=aid, offset=offset, limit=limit)
     return [d.isoformat().replace('T', ' ') for d in dates]
 
 @socketio.on('get_history')
@@ -659,16 +698,9 @@ def revert_history(data):
 
     # compute and apply differential
     diff = edb.diff_article(aid, date)
-    edb.revert_article(aid, diff=diff)
-    order = order_links(diff['link_add'])
+    edits = edb.revert_article(aid, diff=diff)
 
     # send edits to clients
-    edits = {
-        'para_add': diff['para_add'],
-        'para_del': diff['para_del'],
-        'para_upd': diff['para_upd'],
-        'position': order,
-    }
     emit('applyDiff', edits, room=said)
 
     # indicated success
@@ -682,6 +714,22 @@ def move_para(data):
     emit('movePara', [drag_pid,targ_pid], room=str(aid))
     return True
 
+@socketio.on('move_paras')
+@edit_decor
+def move_paras(data):
+    aid, first_pid, last_pid, targ_pid = (
+        data['aid'], data['first_pid'], data['last_pid'], data['targ_pid']
+    )
+    order = edb.get_pids(aid)
+    if first_pid not in order or last_pid not in order:
+        return False
+    block = order[order.index(first_pid):order.index(last_pid)+1]
+    if not edb.move_paras(aid, first_pid, last_pid, targ_pid):
+        return False
+    for prev, pid in zip([targ_pid, *block], block):
+        emit('movePara', [pid, prev], room=str(aid))
+    return True
+
 ###
 ### article editing
 ###
@@ -718,7 +766,8 @@ def set_blurb(data):
 @view_decor
 def search_title(data):
     query, taglist = data['query'], data['tags']
-    results = edb.search_title(query, taglist=taglist)
+    k, offset = data.get('k'), data.get('offset', 0)
+    results = edb.search_title(query, taglist=taglist, k=k, offset=offset)
     return [{
         'short': 'a/' + art.short_title,
         'blurb': art.blurb,
@@ -727,18 +776,32 @@ def search_title(data):
 @socketio.on('search_text')
 @view_decor
 def search_text(data):
-    results = edb.search_text(data)
+    # either the query alone or with k and offset for paging
+    if type(data) is dict:
+        query, k, offset = data['query'], data.get('k'), data.get('offset', 0)
+    else:
+        query, k, offset = data, None, 0
+    results = edb.search_text(query, k=k, offset=offset)
 
     aids = set(par.aid for par in results)
     titles = edb.get_art_titles(aids)
     app.logger.debug(titles)
 
+    # highlighted passages, only with fts
+    snippets = edb.search_snippets(query, [par.pid for par in results])
+
     return [{
         'pid': par.pid,
         'short': titles[par.aid],
-        'raw': par.text
+        'raw': par.text,
+        'snippet': snippets.get(par.pid),
     } for par in results]
 
+@socketio.on('index_status')
+@view_decor
+def index_status(data):
+    return dict(**edb.index_status, cache=edb.search_stats())
+
 @socketio.on('recent_arts')
 @view_decor
 def recent_arts(data):
@@ -1013,5 +1076,41 @@ if not args.no_browser and not args.debug:
     thr = Timer(1, launch_browser)
     thr.start()
 
+# periodically compact old history
+def compact_history():
+    while True:
+        socketio.sleep(config['compact_interval'])
+        horizon = datetime.utcnow() - timedelta(days=config['compact_days'])
+        dropped = edb.compact_history(horizon, granularity=config['compact_granularity'])
+        app.logger.debug(f'compact_history: {dropped}')
+if config['compact_days'] is not None:
+    socketio.start_background_task(compact_history)
+
+# rebuild the search index while serving from the old one
+def reindex_articles():
+    def progress(stage, done, total):
+        app.logger.debug(f'reindex_articles: {stage} {done}/{total}')
+        socketio.sleep(0)
+    edb.reindex_background(progress=progress)
+if args.reindex:
+    socketio.start_background_task(reindex_articles)
+
+# index edited paragraphs once they settle
+def flush_index():
+    while True:
+        socketio.sleep(config['index_interval'])
+        if (num := edb.flush_index(delay=config['index_delay'], limit=config['index_batch'])) > 0:
+            app.logger.debug(f'flush_index: {num}')
+socketio.start_background_task(flush_index)
+
+# keep the memory index file current for the next start
+def save_index():
+    while True:
+        socketio.sleep(config['index_save_interval'])
+        if edb.save_memory_index():
+            app.logger.debug('save_index')
+if args.memory_index:
+    socketio.start_background_task(save_index)
+
 # run through socketio event loop
 socketio.run(app, host=args.ip, port=args.port)
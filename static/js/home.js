@@ -151,13 +151,16 @@ async function searchText(query, last_pid) {
         let pid = par.pid;
         let short = par.short;
         let url = `a/${short}?pid=${pid}`;
-        let raw = par.raw;
-        query.split(' ').forEach(q => {
-            if (q.length > 0) {
-                let re = new RegExp(q, 'i');
-                raw = raw.replace(re, '<span class="hl">$&</span>');
-            }
-        });
+        let raw = par.snippet;
+        if (raw == null) {
+            raw = par.raw;
+            query.split(' ').forEach(q => {
+                if (q.length > 0) {
+                    let re = new RegExp(q, 'i');
+                    raw = raw.replace(re, '<span class="hl">$&</span>');
+                }
+            });
+        }
         let art_div = $('<a>', {class: 'result par_link', href: url, pid: pid});
         let art_blurb = $('<div>', {class: 'par_text', html: raw});
         let art_title = $('<div>', {class: 'blurb_name', text: short});
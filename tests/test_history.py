@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from elltwo.query import ElltwoDB, link_sort
+from elltwo.schema import Paragraph
+
+t0 = datetime(2020, 1, 1)
+prefix = 'a long shared prefix of text here'
+
+def at(minutes):
+    return t0 + timedelta(minutes=minutes)
+
+# an article whose second paragraph is edited once a minute from 2
+def build(edb, title, words):
+    art = edb.create_article(title, time=at(0))
+    pid, = edb.get_pids(art.aid)
+    para = edb.insert_after(pid, prefix, time=at(1))
+    for i, w in enumerate(words):
+        edb.update_para(para.pid, f'{prefix} {w}', time=at(2+i))
+    return art.aid
+
+def texts(edb, aid, time=None):
+    return [p.text for p in edb.get_paras(aid, time=time)]
+
+@pytest.fixture
+def edb(tmp_path):
+    return ElltwoDB(path=tmp_path / 'test.db', create=True, keyframe=8)
+
+def test_purge_reused_rids(edb, tmp_path):
+    other = ElltwoDB(path=tmp_path / 'test.db', keyframe=8)
+    a = build(edb, 'A', ['one', 'two', 'three'])
+    assert texts(edb, a, time=at(3.5))[1] == f'{prefix} two'
+    assert texts(other, a, time=at(3.5))[1] == f'{prefix} two'
+
+    # freed rids go to the new article's revisions
+    edb.purge_article(a)
+    b = build(edb, 'B', ['one', 'green', 'blue'])
+    assert texts(edb, b, time=at(3.5))[1] == f'{prefix} green'
+    other.session.rollback()
+    assert texts(other, b, time=at(3.5))[1] == f'{prefix} green'
+
+def test_reset_reranks(edb):
+    art = edb.create_article('A', time=at(0))
+    pid, = edb.get_pids(art.aid)
+    for i in range(5):
+        pid = edb.insert_after(pid, f'para {i}', time=at(1+i)).pid
+    pids = edb.get_pids(art.aid)
+    edb.insert_after(pids[0], 'inserted', time=at(7))
+    edb.move_para(art.aid, pids[-1], pids[-3], time=at(8))
+
+    # the revert reranks the links it leaves in place, reset revives the rest
+    diff = edb.diff_article(art.aid, at(7.5))
+    edb.revert_article(art.aid, time0=at(9), diff=diff)
+    edb.reset(at(8.5))
+
+    links = edb.get_links(art.aid)
+    rank = {l.pid: l.rank for l in links}
+    order = list(link_sort(links))
+    assert all(rank[p0] < rank[p1] for p0, p1 in zip(order, order[1:]))
+    assert edb.get_pids(art.aid) == order
+
+@pytest.mark.parametrize('keyframe', [None, 8])
+def test_revert_dedup(tmp_path, keyframe):
+    edb = ElltwoDB(path=tmp_path / 'test.db', create=True, keyframe=keyframe, dedup=True)
+    art = edb.create_article('A', time=at(0))
+    pid, = edb.get_pids(art.aid)
+    para = edb.insert_after(pid, 'first text', time=at(1))
+    extra = edb.insert_after(para.pid, 'extra text', time=at(2))
+    edb.update_para(para.pid, 'second text', time=at(3))
+    before = texts(edb, art.aid, time=at(1.5))
+
+    # the revert replaces one paragraph and deletes another
+    diff = edb.diff_article(art.aid, at(1.5))
+    edb.revert_article(art.aid, time0=at(4), diff=diff)
+    assert texts(edb, art.aid) == before
+
+    closed = edb.session.query(Paragraph).filter(
+        Paragraph.pid.in_([para.pid, extra.pid]), Paragraph.delete_time == at(4)
+    ).all()
+    assert len(closed) == 2
+    assert all(p.text == '' or p.base is not None for p in closed)
+    assert texts(edb, art.aid, time=at(3.5)) == ['#! A', 'second text', 'extra text']
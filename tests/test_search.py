@@ -0,0 +1,69 @@
+import pytest
+
+from elltwo.query import ElltwoDB, shardify_document, shard_compress
+
+titles = ['Linear Algebra', 'Algebraic Topology', 'Topology Notes', 'Real Analysis']
+paras = [
+    'the theorem follows from the definition of a vector space',
+    'every compact metric space is complete and totally bounded',
+    'the default value is returned when the key is missing',
+    'import os and read the configuration from the environment',
+    'there are other ways to prove the theorem',
+]
+queries = ['theorem', 'the', 'vector spaces', 'algebra', 'topolgy', 'import os', 'zzqx']
+
+def shards(text):
+    return {i: shard_compress(s) for i, s in shardify_document(text).items()}
+
+def assert_close(a, b, tol=1e-9):
+    assert a.keys() == b.keys()
+    assert all(abs(a[k] - b[k]) < tol for k in a)
+
+@pytest.fixture
+def edb(tmp_path):
+    edb = ElltwoDB(path=tmp_path / 'test.db', create=True)
+    for i, t in enumerate(titles):
+        edb.index_document('title', i, t, clear=True, commit=False)
+        edb.index_document('title', i, t.lower().replace(' ', '_'), commit=False)
+    for i, p in enumerate(paras):
+        edb.index_document('para', i, p, commit=False)
+    edb.session.commit()
+    return edb
+
+@pytest.mark.parametrize('query', queries)
+@pytest.mark.parametrize('dtype', [None, 'title', 'para'])
+def test_sql_matches_python(edb, query, dtype):
+    s = shards(query)
+    assert_close(edb.score_sql(s, dtype=dtype), edb.score_python(s, dtype=dtype))
+
+@pytest.mark.parametrize('query', queries)
+@pytest.mark.parametrize('dtype', [None, 'title', 'para'])
+def test_memory_matches_python(edb, query, dtype):
+    pytest.importorskip('numpy')
+    edb.load_memory_index()
+    s = shards(query)
+    assert_close(edb.memory.score(s, dtype=dtype), edb.score_python(s, dtype=dtype))
+
+def test_parity_after_edits(edb):
+    pytest.importorskip('numpy')
+    edb.load_memory_index()
+    edb.index_document('para', 1, 'a theorem about vector bundles', clear=True)
+    edb.unindex_document('para', 3)
+    edb.index_document('title', 0, 'Abstract Algebra', clear=True)
+    for query in queries:
+        s = shards(query)
+        want = edb.score_python(s)
+        assert_close(edb.score_sql(s), want)
+        assert_close(edb.memory.score(s), want)
+
+@pytest.mark.parametrize('engine', ['sql', 'memory'])
+def test_topk_paging(edb, engine):
+    if engine == 'memory':
+        pytest.importorskip('numpy')
+        edb.load_memory_index()
+    for query in queries:
+        full = edb.search_index(query, engine='python')
+        assert edb.search_topk(query, k=0, engine=engine) == []
+        for offset in (0, 2):
+            page = edb.search_topk(query, k=3, offset=offset, engine=engine)
+            assert [round(x, 9) for _, x in page] == [round(x, 9) for _, x in full[offset:offset+3]]